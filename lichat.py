@@ -10,6 +10,10 @@ SCRIPT_DESC = 'Client for Lichat protocol (https://shirakumo.github.io/lichat)'
 import_ok = True
 
 import sys
+import time
+# Start of script load, for profile_startup
+load_started = time.perf_counter()
+
 if sys.version_info[0] < 3 or sys.version_info[1] < 7:
     print('Your Python version ('+str(sys.version_info[0])+'.'+str(sys.version_info[1])+') is too old!')
     print('Please update to 3.7 or later.')
@@ -23,18 +27,22 @@ except ImportError:
     import_ok = False
 
 try:
-    from collections import deque
+    from collections import deque, OrderedDict
     from functools import wraps
     from inspect import signature
     from pathlib import Path
-    import shlex
+    from bisect import bisect_left
+    from fnmatch import fnmatchcase
     import json
-    import urllib.request
+    import codecs
     import socket
+    import ssl
     import base64
+    import hashlib
+    import os
     import re
+    import random
     import mimetypes
-    import time
     import pylichat
     import inspect
     import logging
@@ -80,14 +88,49 @@ class WeechatHandler(logging.Handler):
 
 data_save_directory = ''
 data_save_types = []
+data_store = None
 imgur_client_id = ''
 imgur_formats = ['video/mp4', 'video/webm', 'video/x-matroska', 'video/quicktime',
                  'video/x-flv', 'video/x-msvideo', 'video/x-ms-wmv', 'video/mpeg',
                  'image/png', 'image/jpeg', 'image/gif', 'image/tiff', 'image/vnd.mozilla.apng']
 config_file = None
+# Set while the setup reads the config file, see config_option_change_cb
+config_reloading = False
 config = {}
+behaviour = None
 commands = {}
 servers = {}
+render_cache = {}
+# (phase, time) marks while the script is loading, see startup_phase
+startup_phases = []
+startup_report = ''
+tag_plans = {}
+# Resolution of keepalive, reconnect and backfill deadlines, in milliseconds.
+tick_interval = 100
+# Write buffer size past which it is written out without waiting for the end of the callback (bytes)
+write_flush_size = 65536
+# How long a connection must last before reconnects start over at the shortest delay (seconds)
+stable_connection_time = 300
+# How many saved updates the data store index remembers the file of
+data_index_size = 10000
+
+def startup_phase(name):
+    """Mark the end of a phase of loading the script, for profile_startup."""
+    if startup_phases is not None:
+        startup_phases.append((name, time.perf_counter()))
+
+def finish_startup():
+    global startup_phases, startup_report
+    startup_phase('autoconnect')
+    previous = load_started
+    parts = []
+    for (name, mark) in startup_phases:
+        parts.append(f"{name} {(mark-previous)*1000:.1f} ms")
+        previous = mark
+    startup_report = f"Loaded in {(previous-load_started)*1000:.1f} ms: {', '.join(parts)}"
+    startup_phases = None
+    if behaviour.profile_startup:
+        w.prnt("", f"lichat: {startup_report}")
 
 def register_command(name, func, description='', cmdtype='lichat', completion=''):
     commands[name] = {'name': name, 'func': func, 'description': description, 'cmdtype': cmdtype, 'completion': completion}
@@ -112,7 +155,7 @@ def lichat_buffer_input_cb(_data, w_buffer, input_data):
 
 def lichat_buffer_close_cb(_data, w_buffer):
     buffer = weechat_buffer_to_representation(w_buffer)
-    if buffer.server.is_connected():
+    if buffer.server.state == 'connected':
         def cb(client, prev, update):
             if isinstance(update, Failure):
                 buffer.server.show(update, kind='error')
@@ -124,15 +167,65 @@ def lichat_buffer_close_cb(_data, w_buffer):
 def lichat_socket_cb(name, fd):
     server = servers[name]
     try:
-        for update in server.client.recv():
-            server.client.handle(update)
+        if server.state == 'tls':
+            server.tls_handshake()
+        elif server.state == 'handshake':
+            server.receive_handshake()
+        else:
+            server.pending.extend(server.receive())
+            server.handle_pending()
     except pylichat.ConnectionLost:
         logger.info(f"[{name}] connection lost", exc_info=True)
         server.disconnected_error()
-    except Exception as e:
+    except Exception:
         logger.exception(f"[{name}] error in lichat_socket_cb")
     return w.WEECHAT_RC_OK
 
+def lichat_write_cb(name, _remaining):
+    server = servers.get(name, None)
+    if server != None:
+        server.write_timer = None
+        server.try_flush_writes()
+    return w.WEECHAT_RC_OK
+
+def lichat_writable_cb(name, fd):
+    server = servers.get(name, None)
+    if server != None:
+        w.unhook(server.write_blocked)
+        server.write_blocked = None
+        server.pump_upload()
+        server.try_flush_writes()
+    return w.WEECHAT_RC_OK
+
+def lichat_connect_cb(name, status, gnutls_rc, sock, error, ip_address):
+    server = servers.get(name, None)
+    if server == None or server.state != 'resolving':
+        if status == w.WEECHAT_HOOK_CONNECT_OK:
+            os.close(sock)
+        return w.WEECHAT_RC_OK
+    server.connect_hook = None
+    if status == w.WEECHAT_HOOK_CONNECT_OK:
+        server.socket_connected(sock)
+    else:
+        reasons = {
+            w.WEECHAT_HOOK_CONNECT_ADDRESS_NOT_FOUND: 'Address not found',
+            w.WEECHAT_HOOK_CONNECT_IP_ADDRESS_NOT_FOUND: 'IP address not found',
+            w.WEECHAT_HOOK_CONNECT_CONNECTION_REFUSED: 'Connection refused',
+            w.WEECHAT_HOOK_CONNECT_TIMEOUT: 'Timeout',
+            w.WEECHAT_HOOK_CONNECT_SOCKET_ERROR: 'Socket error',
+            w.WEECHAT_HOOK_CONNECT_MEMORY_ERROR: 'Out of memory'
+        }
+        reason = reasons.get(status, f"Error {status}")
+        server.connect_failed(message=f"{reason} ({error})" if error else reason)
+    return w.WEECHAT_RC_OK
+
+def lichat_pending_cb(name, _remaining):
+    server = servers.get(name, None)
+    if server != None:
+        server.pending_hook = None
+        server.handle_pending()
+    return w.WEECHAT_RC_OK
+
 def input_prompt_cb(data, item, current_window, w_buffer, extra_info):
     buffer = weechat_buffer_to_representation(w_buffer)
     if buffer == None:
@@ -140,50 +233,41 @@ def input_prompt_cb(data, item, current_window, w_buffer, extra_info):
     
     return f"{wcfgcolor('irc.color.input_nick')}{buffer.server.client.username}"
 
-def reconnect_cb(data, _remaining):
-    server = servers.get(data, None)
-    if server != None:
-        server.reconnect()
+def outbox_item_cb(data, item, current_window, w_buffer, extra_info):
+    buffer = weechat_buffer_to_representation(w_buffer)
+    if buffer == None:
+        return ''
+    depth = buffer.server.outbox_depth()
+    return f"{depth} queued" if depth else ''
+
+def lag_item_cb(data, item, current_window, w_buffer, extra_info):
+    buffer = weechat_buffer_to_representation(w_buffer)
+    if buffer == None:
+        return ''
+    return buffer.server.lag_text()
+
+def bar_items_update_cb(data, signal, signal_data):
+    w.bar_item_update('lichat_outbox')
+    w.bar_item_update('lichat_lag')
     return w.WEECHAT_RC_OK
 
-def timeout_cb(data, _remaining):
-    server = servers.get(data, None)
-    if server != None:
-        if server.ping_sent_at is None:
-            logger.debug(f"[{server.name}] timeout, sending ping")
-            server.ping_sent_at = time.monotonic()
-            server.send(Ping)
-            server.timeout = w.hook_timer(1000*30, 1, 1, 'timeout_cb', server.name)
-        else:
-            logger.debug(f"[{server.name}] timeout 2, reconnecting")
-            server.show(text="Timed out, reconnecting...", kind='network', show_source=False)
-            server.disconnect()
-            server.reconnect()
+def tick_cb(_data, _remaining):
+    now = time.monotonic()
+    for server in list(servers.values()):
+        server.tick(now)
     return w.WEECHAT_RC_OK
 
+def format_size(size):
+    for unit in ('B', 'KiB', 'MiB'):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GiB"
+
 def format_alist(list, key_separator=': ', entry_separator='\n'):
     return entry_separator.join([f"{x[0]}{key_separator}{x[1]}" for x in list])
 
-def search_buffer(w_buffer, matcher, gather=True):
-    h_line = w.hdata_get('line')
-    h_line_data = w.hdata_get('line_data')
-    lines = w.hdata_pointer(w.hdata_get('buffer'), w_buffer, 'own_lines')
-    line = w.hdata_pointer(w.hdata_get('lines'), lines, 'last_line')
-
-    while line and not matcher(h_line, h_line_data, line):
-        line = w.hdata_move(h_line, line, -1)
-
-    if gather:
-        line_ptrs = []
-        while line and matcher(h_line, h_line_data, line):
-            line_ptrs.append(line)
-            line = w.hdata_move(h_line, line, -1)
-            line_ptrs.reverse()
-        return line_ptrs
-    return None
-
-def edit_buffer(w_buffer, matcher, new_text):
-    line_ptrs = search_buffer(w_buffer, matcher)
+def edit_lines(line_ptrs, new_text):
     if not line_ptrs: return False
 
     line_text = new_text.split('\n', len(line_ptrs)-1)
@@ -197,12 +281,166 @@ def edit_buffer(w_buffer, matcher, new_text):
         w.hdata_update(h_line_data, data, {'message': text})
     return True
 
-def buffer_backfill_timeout_cb(data, _remaining):
-    buffer = weechat_buffer_to_representation(data)
+def tag_plan(update_type, tags):
+    """Returns a fresh tag list for showing an update of the given type.
+
+The static part (the caller's tags followed by the lichat_type_* tag) is
+joined once per update type and set of tags, and reused as the first
+entry of the list."""
+    key = (update_type, tuple(tags))
+    plan = tag_plans.get(key, None)
+    if plan is None:
+        plan = list(tags)
+        if update_type is not None:
+            plan.append(f"lichat_type_{update_type.__name__.lower()}")
+        plan = tag_plans[key] = ','.join(plan)
+    return [plan] if plan else []
+
+def line_has_tags(h_line, h_line_data, line, tags):
+    missing = set(tags)
+    data = w.hdata_pointer(h_line, line, 'data')
+    for i in range(w.hdata_integer(h_line_data, data, 'tags_count')):
+        missing.discard(w.hdata_string(h_line_data, data, f"{i}|tags_array"))
+        if not missing: return True
+    return False
+
+def line_key(update):
+    """Returns the (id, from) tags identifying the lines an update was shown on."""
+    if update.get('id') is None or not update.get('from'):
+        return None
+    return (f"lichat_id_{str(update['id'])}", f"lichat_from_{update['from']}")
+
+class LineIndex:
+    """Maps the line_key of shown updates to the buffer lines they were printed on.
+
+WeeChat only frees lines from the head of a buffer (or clears it
+entirely), so entries are kept in print order and pruned by walking
+forward from the first line whenever it changes."""
+    def __init__(self, w_buffer):
+        self.h_line = w.hdata_get('line')
+        self.h_line_data = w.hdata_get('line_data')
+        self.h_lines = w.hdata_get('lines')
+        self.lines = w.hdata_pointer(w.hdata_get('buffer'), w_buffer, 'own_lines')
+        self.entries = OrderedDict()
+        self.keys = {}
+        self.head = None
+
+    def last_line(self):
+        return w.hdata_pointer(self.h_lines, self.lines, 'last_line')
+
+    def clear(self):
+        self.entries.clear()
+        self.keys.clear()
+        self.head = None
+
+    def forget(self, key):
+        for line in self.entries.pop(key, []):
+            self.keys.pop(line, None)
+
+    def prune(self):
+        head = w.hdata_pointer(self.h_lines, self.lines, 'first_line')
+        if head == self.head: return
+        self.head = head
+
+        ## Find the oldest line that is still indexed. Pointers may have
+        ## been reused by newer lines, so confirm by the line's tags.
+        line = head
+        key = None
+        while line and self.entries:
+            key = self.keys.get(line)
+            if key is not None and line_has_tags(self.h_line, self.h_line_data, line, key):
+                break
+            key = None
+            line = w.hdata_move(self.h_line, line, 1)
+
+        ## Everything printed before it has been freed.
+        while self.entries:
+            oldest, line_ptrs = next(iter(self.entries.items()))
+            if oldest == key:
+                first = line_ptrs.index(line)
+                for freed in line_ptrs[:first]:
+                    del self.keys[freed]
+                del line_ptrs[:first]
+                break
+            self.forget(oldest)
+
+    def add(self, key, since, count):
+        """Index the lines printed after the line pointer since, up to count lines."""
+        self.prune()
+        line_ptrs = []
+        line = self.last_line()
+        while line and line != since and len(line_ptrs) < count:
+            line_ptrs.append(line)
+            line = w.hdata_move(self.h_line, line, -1)
+        line_ptrs.reverse()
+
+        self.forget(key)
+        for line in line_ptrs:
+            if line in self.keys:
+                self.forget(self.keys[line])
+            self.keys[line] = key
+        self.entries[key] = line_ptrs
+
+    def find(self, key):
+        self.prune()
+        return self.entries.get(key)
+
+def buffer_cleared_cb(_data, _signal, w_buffer):
+    buffer = weechat_buffer_to_representation(w_buffer)
     if buffer is not None:
-        buffer.backfill_timeout()
+        buffer.line_index.clear()
     return w.WEECHAT_RC_OK
 
+class RecentUpdates:
+    """Window of recently seen updates for backfill deduplication.
+
+Updates are identified by their clock, sender and id, and kept in arrival
+order grouped into buckets of equal clock, so both membership checks and
+trimming the window from the front are constant time."""
+    def __init__(self):
+        self.buckets = deque()
+        self.counts = {}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def key(self, update):
+        # workaround for ex-lichat currently returning backfill with str ids
+        return (update.get('clock'), update.get('from'), str(update.get('id')))
+
+    def oldest(self):
+        return self.buckets[0][0]
+
+    def newest(self):
+        return self.buckets[-1][0]
+
+    def seen(self, update):
+        return self.key(update) in self.counts
+
+    def add(self, update):
+        key = self.key(update)
+        if len(self.buckets) == 0 or self.buckets[-1][0] != key[0]:
+            self.buckets.append((key[0], deque()))
+        self.buckets[-1][1].append(key)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.size += 1
+
+    def popleft(self):
+        (_, keys) = self.buckets[0]
+        key = keys.popleft()
+        if len(keys) == 0:
+            self.buckets.popleft()
+        self.counts[key] -= 1
+        if self.counts[key] == 0:
+            del self.counts[key]
+        self.size -= 1
+
+    def trim(self, count, clock):
+        """Drop the oldest updates beyond count or from before clock, keeping at least one."""
+        while self.size > 1 and (self.size > count or self.oldest() < clock):
+            self.popleft()
+
 class Buffer:
     def __init__(self, server, channel, name=None):
         if name == None: name = channel
@@ -238,13 +476,17 @@ class Buffer:
         server.buffers[channel] = self
 
         self.multiplicity = 0
+        self.line_index = LineIndex(self.buffer)
+        # (id, from) of recently shown messages, newest last
+        self.messages = deque(maxlen=behaviour.recent_messages_count)
+        self.own_messages = deque(maxlen=self.messages.maxlen)
 
         self.backfill_time = None
         self.backfill_deferred = []
-        self.backfill_timeout_hook = None
+        self.backfill_deadline = None
         if server.client.is_supported('shirakumo-backfill'):
             self.backfill_state = 'wait'
-            self.recent_updates = deque()
+            self.recent_updates = RecentUpdates()
             self.backfill_timer()
         else:
             self.backfill_state = 'never'
@@ -268,20 +510,19 @@ class Buffer:
         1: one-on-one dm
         2: multi-party dm/channel
         """
-        channel = self.server.client.channels[self.channel]
-        # users except for me
-        users = channel.users - {self.server.client.username}
+        others = self.other_users()
 
         multiplicity = 0
-        if self.is_query() and len(users) == 1:
+        if self.is_query() and others == 1:
             multiplicity = 1
-        elif len(users) > 1:
+        elif others > 1:
             multiplicity = 2
 
         if self.multiplicity == multiplicity:
             # unchanged
             return
 
+        self.multiplicity = multiplicity
         w.buffer_set(self.buffer, 'nicklist', '0' if multiplicity < 2 else '1')
         self.update_title(self.title)
 
@@ -293,24 +534,35 @@ class Buffer:
             # self.name = self.channel
         # w.buffer_set(self.buffer, 'name', self.w_name())
 
+    def other_users(self):
+        """Returns the number of users in the channel except for me, without copying the user set."""
+        users = self.server.client.channels[self.channel].users
+        if self.server.client.username in users:
+            return len(users) - 1
+        return len(users)
+
     def update_title(self, title):
         if self.multiplicity == 1:
-            # users except for me
-            users = self.server.client.channels[self.channel].users - {self.server.client.username}
             # the other person in the DM
-            user = next(iter(users))
+            me = self.server.client.username.casefold()
+            user = next(user for user in self.server.client.channels[self.channel].users if user.casefold() != me)
             w.buffer_set(self.buffer, 'short_name', title or f' {user}')
-            w.buffer_set(self.buffer, 'title', title or f'DM with {next(iter(user))} ({self.channel})')
+            w.buffer_set(self.buffer, 'title', title or f'DM with {user} ({self.channel})')
         else:
             w.buffer_set(self.buffer, 'short_name', title or self.name)
             w.buffer_set(self.buffer, 'title', title or '')
         self.title = title
 
     def join(self, user):
+        self.join_all([user])
+
+    def join_all(self, users):
+        """Add a batch of users to the nicklist, updating the multiplicity only once."""
         self.update_multiplicity()
         if self.nicklist == None:
             self.nicklist = w.nicklist_add_group(self.buffer, '', 'Users', 'weechat.color.nicklist_group', 1)
-        w.nicklist_add_nick(self.buffer, self.nicklist, user, 'bar_fg', '', 'bar_fg', 1)
+        for user in users:
+            w.nicklist_add_nick(self.buffer, self.nicklist, user, 'bar_fg', '', 'bar_fg', 1)
 
     def leave(self, user):
         self.update_multiplicity()
@@ -368,10 +620,7 @@ class Buffer:
         w.prnt_date_tags(self.buffer, 0, "no_log", f"\t\t---------------- {text} ----------------")
 
     def backfill_timer(self):
-        if self.backfill_timeout_hook:
-            w.unhook(self.backfill_timeout_hook)
-        self.backfill_timeout_hook = w.hook_timer(cfg('behaviour', 'backfill_timeout', int, 1000),
-                                                  0, 1, 'buffer_backfill_timeout_cb', self.buffer)
+        self.backfill_deadline = time.monotonic() + behaviour.backfill_timeout / 1000
 
     def backfill_timeout(self):
         if self.backfill_state in ['wait', 'join']:
@@ -382,17 +631,26 @@ class Buffer:
 
     def backfill_flush(self):
         """Flush updates deferred by backfill"""
-        if self.backfill_timeout_hook:
-            w.unhook(self.backfill_timeout_hook)
+        self.backfill_deadline = None
         if self.backfill_state == 'none':
             self.backfill_message("No backfill")
         elif self.backfill_state == 'done':
             self.backfill_message("End of backfill")
         self.backfill_state = 'flushed'
 
-        for args in self.backfill_deferred:
-            self.show(**args)
-        self.backfill_deferred.clear()
+        if self.backfill_deferred:
+            # These arrived while we were joining, so they are printed without
+            # notifying or highlighting. Hotlist updates are also held for the
+            # batch, which WeeChat only supports for all buffers at once.
+            w.buffer_set(self.buffer, 'hotlist', '-')
+            try:
+                for fields in self.backfill_deferred:
+                    (_, _, clock, source, id) = fields[:5]
+                    if not self.backfill_deduplicate({'clock': clock, 'from': source, 'id': id}):
+                        self.print_line(self.render(*fields, quiet=True))
+            finally:
+                w.buffer_set(self.buffer, 'hotlist', '+')
+                self.backfill_deferred.clear()
 
     def backfill_statemachine(self, update):
         """Update the backfill state machine.
@@ -427,26 +685,22 @@ Returns True if show() should defer the update."""
         """Backfill deduplication.
 
 Returns True if show() should skip displaying the update."""
+        if self.backfill_state == 'never':
+            return False
 
+        recent = self.recent_updates
         if (self.backfill_state == 'backfill'
-            and len(self.recent_updates) > 0
-            and update.get('clock', 0) <= self.recent_updates[-1].get('clock')):
+            and len(recent) > 0
+            and update.get('clock', 0) <= recent.newest()):
             # This backfill update predates the most recent update
             # we've seen, check the uncertainty window
 
-            if update.get('clock', 0) >= self.recent_updates[0].get('clock'):
+            if update.get('clock', 0) >= recent.oldest():
                 # This backfill update is within the uncertainty
-                # window, compare it to all recently seen updates
-
-                for ru in self.recent_updates:
-                    if (ru.get('clock') == update.get('clock')
-                        and ru.get('from') == update.get('from')
-                        # workaround for ex-lichat currently returning backfill with str ids
-                        and str(ru.get('id')) == str(update.get('id'))):
-
-                        # We've already seen this backfill update, skip it
-                        logger.debug(f"Skipping update; recently seen {update}")
-                        return True
+                # window, check whether we've recently seen it
+                if recent.seen(update):
+                    logger.debug(f"Skipping update; recently seen {update}")
+                    return True
             else:
                 # This backfill update predates the start of recent_updates, skip it
                 logger.debug(f"Skipping update; predates recently seen {update}")
@@ -455,41 +709,35 @@ Returns True if show() should skip displaying the update."""
         # Store recently seen updates
         if (self.backfill_state != 'none'
             and update.get('clock')
-            and (len(self.recent_updates) == 0
-                 or update.get('clock') >= self.recent_updates[0].get('clock'))):
-
-            self.recent_updates.append(update)
-
-            # Clean up the queue
-            while (len(self.recent_updates) > 1
-                   and (len(self.recent_updates) > cfg('behaviour', 'backfill_window_count', int, 255)
-                        or (self.recent_updates[0].get('clock') < update.get('clock')
-                            - cfg('behaviour', 'backfill_window_time', int, 30)))):
-                self.recent_updates.popleft()
+            and (len(recent) == 0 or update.get('clock') >= recent.oldest())):
+            recent.add(update)
+            recent.trim(behaviour.backfill_window_count,
+                        update.get('clock') - behaviour.backfill_window_time)
         return False
 
-    def show(self, update=None, text=None, kind='action', tags=[], show_source=True):
-        time = 0
-        prefix_color = ""
-
-        if update is None:
-            update = {'from': self.server.client.servername}
-        else:
+    def show(self, update=None, text=None, kind='action', tags=(), show_source=True):
+        if update is not None:
             if self.backfill_statemachine(update):
                 logger.debug(f"Update deferred by backfill {update}")
-                self.backfill_deferred.append({'update': update, 'text': text, 'kind': kind, 'tags': tags, 'show_source': show_source})
+                # Keep only the fields the line is rendered from, rather than the whole update.
+                self.backfill_deferred.append(self.line_fields(update, text, kind, tags, show_source))
                 return self
 
             if self.backfill_deduplicate(update):
                 return self
 
-            time = update.unix_clock()
-            tags.append(f"lichat_type_{update.__class__.__name__.lower()}")
-            if update.get('id'):
-                tags.append(f"lichat_id_{str(update['id'])}")
-            if update.get('from'):
-                tags.append(f"lichat_from_{update['from']}")
-                tags.append(f"nick_{update['from'].replace(' ','_')}")
+        self.print_line(self.render(*self.line_fields(update, text, kind, tags, show_source)))
+        return self
+
+    def line_fields(self, update=None, text=None, kind='action', tags=(), show_source=True):
+        """Extract what rendering an update needs from it.
+
+Returns a tuple of the update type, unix time, clock, from, id, bridge,
+text, kind, tags, show_source and in-regards-to line, as consumed by
+render. The text is resolved here, as is the update that caused a
+failure, which client.origin() only knows while the update is handled."""
+        if update is None:
+            return (None, 0, None, self.server.client.servername, None, None, text, kind, tags, show_source, None)
 
         # if known, show the update which caused the failure on its own line
         in_regards_to = None
@@ -500,127 +748,379 @@ Returns True if show() should skip displaying the update."""
                 if isinstance(update, UpdateFailure):
                     origin = self.server.client.origin(update)
                     if origin != None:
-                        in_regards_to = f"{w.prefix('network')}{w.color('gray')}in regards to {pylichat.wire.to_string(origin.to_list())}"
-                        tags.append('no_highlight')
+                        in_regards_to = f"{render_style('prefix', 'network')}{render_style('color', 'gray')}in regards to {pylichat.wire.to_string(origin.to_list())}"
             else:
                 text = f"BUG: Supposed to show non-update {update}"
 
-        if update.get('from') and (kind in ["text", "action"]
-                                   or w.config_boolean(w.config_get("irc.look.color_nicks_in_server_messages"))):
-            if self.server.client.is_my_own(update):
-                prefix_color = wcfgcolor('weechat.color.chat_nick_self')
+        return (type(update), update.unix_clock(), update.get('clock'), update.get('from'), update.get('id'), update.get('bridge'),
+                text, kind, tags, show_source, in_regards_to)
+
+    def render(self, update_type, time, clock, source, id, bridge, text, kind, tags, show_source, in_regards_to, quiet=False):
+        """Render the fields of an update into the line(s) to print for it.
+
+If quiet is true, the line neither notifies nor highlights. Returns a tuple of the date, tags, message, in-regards-to line, line_key
+and recent message entry, as consumed by print_line."""
+        prefix_color = ""
+        own = source == self.server.client.username and bridge is None
+        key = None
+
+        tags = tag_plan(update_type, tags)
+        if update_type is not None:
+            if id:
+                tags.append(f"lichat_id_{str(id)}")
+            if source:
+                tags.append(f"lichat_from_{source}")
+                tags.append(f"nick_{source.replace(' ','_')}")
+                if id is not None:
+                    key = (f"lichat_id_{str(id)}", f"lichat_from_{source}")
+        if in_regards_to is not None:
+            tags.append('no_highlight')
+
+        if source and (kind in ["text", "action"]
+                       or render_style('boolean', 'irc.look.color_nicks_in_server_messages')):
+            if own:
+                prefix_color = render_style('option_color', 'weechat.color.chat_nick_self')
             else:
-                prefix_color = w.color(w.info_get("nick_color_name", update['from']))
+                prefix_color = render_style('nick_color', source)
 
-        source = f"{prefix_color}{update.get('from', '')}{w.color('reset')}"
+        source_text = f"{prefix_color}{source or ''}{render_style('color', 'reset')}"
 
-        if update.get('bridge'):
-            source = f"{source}*"
+        if bridge:
+            source_text = f"{source_text}*"
 
         if show_source is False:
-            source = ""
+            source_text = ""
 
-        if self.server.client.is_my_own(update):
+        if own:
             tags += ['notify_none', 'self_msg', 'no_highlight']
+        elif quiet:
+            tags += ['notify_none', 'no_highlight']
 
         if kind == 'text':
-            nick_prefix = wcfgstr('weechat.look.nick_prefix', 'weechat.color.chat_nick_prefix')
-            nick_suffix = wcfgstr('weechat.look.nick_suffix', 'weechat.color.chat_nick_suffix')
+            nick_prefix = render_style('nick_prefix')
+            nick_suffix = render_style('nick_suffix')
 
-            if not self.server.client.is_my_own(update):
+            if not own and not quiet:
                 if self.is_query():
                     tags += ['notify_private']
                 else:
                     tags += ['notify_message']
 
-            w.prnt_date_tags(self.buffer, time, ','.join(tags), f"{nick_prefix}{source}{nick_suffix}\t{text}")
+            message = f"{nick_prefix}{source_text}{nick_suffix}\t{text}"
         else:
             sep = ""
-            if len(source) > 0:
+            if len(source_text) > 0:
                 if show_source == 'bare':
                     sep = " "
                 else:
                     sep = ": "
 
-            w.prnt_date_tags(self.buffer, time, ','.join(tags), f"{w.prefix(kind)}{source}{sep}{text}")
+            message = f"{render_style('prefix', kind)}{source_text}{sep}{text}"
+
+        entry = None
+        if update_type is Message:
+            entry = (id, source)
+        return (time, ','.join(tags), message, in_regards_to, key, entry)
+
+    def print_line(self, line):
+        (time, tags, message, in_regards_to, key, entry) = line
+        if key is not None:
+            since = self.line_index.last_line()
+        w.prnt_date_tags(self.buffer, time, tags, message)
+        if key is not None:
+            self.line_index.add(key, since, message.count('\n')+1)
+        if entry is not None:
+            self.add_message(entry)
 
         if in_regards_to is not None:
             w.prnt_date_tags(self.buffer, time, 'no_highlight', in_regards_to)
 
-        return self
+    def add_message(self, entry):
+        if entry[1] == self.server.client.username:
+            if not self.own_messages or self.own_messages[-1] != entry:
+                self.own_messages.append(entry)
+        if not self.messages or self.messages[-1] != entry:
+            self.messages.append(entry)
 
     def edit(self, update, text=None):
-        id = 'lichat_id_'+str(update['id'])
-        source = 'lichat_from_'+update['from']
         if text == None: text = update['text']
+        return edit_lines(self.line_index.find(line_key(update)), text)
 
-        def matcher(h_line, h_line_data, line):
-            found_id = False
-            found_source = False
-            data = w.hdata_pointer(h_line, line, 'data')
-            for i in range(w.hdata_integer(h_line_data, data, 'tags_count')):
-                tag = w.hdata_string(h_line_data, data, f"{i}|tags_array")
-                if tag == id: found_id = True
-                if tag == source: found_source = True
-                if found_id and found_source: return True
-            return False
-        
-        return edit_buffer(self.buffer, matcher, text)
+class LazyEmote(pylichat.client.Emote):
+    """An emote on disk whose payload is only read once something needs it."""
+    __slots__ = 'path', 'data'
+
+    def __init__(self, name, content_type, path):
+        self.name = name
+        self.content_type = content_type
+        self.path = path
+        self.data = None
+
+    @property
+    def payload(self):
+        if self.data is None:
+            with open(self.path, 'rb') as file:
+                self.data = file.read()
+        return self.data
+
+def index_emotes(client, directory):
+    """Like Client.reload_emotes, but only looks at the file names."""
+    for path in os.listdir(directory):
+        (content_type, _) = mimetypes.guess_type(path, False)
+        if content_type != None:
+            name = Path(path).stem
+            client.emotes[name] = LazyEmote(name, content_type, directory+path)
+
+class EmoteIndex:
+    """Case-insensitively sorted emote names of a server, for prefix completion.
+
+Sorting is deferred until the next lookup, so that a burst of emotes on
+connect does not sort the names over and over."""
+    def __init__(self, names=()):
+        self.names = {}
+        self.keys = []
+        self.sorted = True
+        for name in names:
+            self.add(name)
+
+    def add(self, name):
+        key = name.casefold()
+        if key not in self.names:
+            self.keys.append(key)
+            self.sorted = False
+        self.names[key] = name
+
+    def ensure_sorted(self):
+        if not self.sorted:
+            self.keys.sort()
+            self.sorted = True
+
+    def __contains__(self, name):
+        return name.casefold() in self.names
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, i):
+        self.ensure_sorted()
+        return self.names[self.keys[i]]
+
+    def __iter__(self):
+        self.ensure_sorted()
+        return (self.names[key] for key in self.keys)
+
+    def prefixed(self, prefix):
+        """Returns the range of indices of the emotes starting with prefix."""
+        self.ensure_sorted()
+        prefix = prefix.casefold()
+        start = bisect_left(self.keys, prefix)
+        end = bisect_left(self.keys, prefix+'\U0010ffff', start)
+        return range(start, end)
+
+class LatencyHistogram:
+    """Rolling window of the most recent ping round-trip times, in seconds."""
+    # Upper bounds of the buckets shown by /lichat lag, in seconds
+    bounds = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, size=120):
+        self.samples = deque(maxlen=size)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+
+    def clear(self):
+        self.samples.clear()
+
+    def percentiles(self, *ps):
+        """Returns the nearest-rank percentiles of the window, or None if it is empty."""
+        if not self.samples: return None
+        ordered = sorted(self.samples)
+        return [ordered[min(len(ordered)-1, int(p / 100 * len(ordered)))] for p in ps]
+
+    def buckets(self):
+        """Returns a list of (upper bound, count) pairs, the last bound being None."""
+        counts = [0] * (len(self.bounds) + 1)
+        for sample in self.samples:
+            counts[bisect_left(self.bounds, sample)] += 1
+        return list(zip(self.bounds + (None,), counts))
+
+class Upload:
+    """A file being streamed to the server as a Data update.
+
+The file is read and base64 encoded a chunk at a time, only as fast as
+the socket takes it, so memory use does not grow with the file size."""
+    # A multiple of 3, so that chunks encode without base64 padding
+    chunk_size = 3 * 16384
+
+    def __init__(self, buffer, update, path, spooled=False):
+        self.buffer = buffer
+        self.update = update
+        self.path = path
+        # Spooled files are temporary and deleted once the upload is done.
+        self.spooled = spooled
+        self.file = None
+        self.size = 0
+        self.sent = 0
+        self.shown = None
+
+    def open(self):
+        self.file = open(self.path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+
+    def read(self):
+        chunk = self.file.read(self.chunk_size)
+        self.sent += len(chunk)
+        return base64.b64encode(chunk)
+
+    def close(self):
+        if self.file != None:
+            self.file.close()
+            self.file = None
+        if self.spooled:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def show(self, text):
+        self.buffer.edit(self.update, f"{text} {self.update['filename']}")
+
+    def show_progress(self):
+        percent = 100 * self.sent // self.size if self.size else 100
+        if percent // 5 != self.shown:
+            self.shown = percent // 5
+            self.show(f"Sending file ({percent}%)")
+
+def send_lane(type):
+    """Returns the outbox lane updates of the given type are queued in.
+
+None means the update bypasses the outbox, lane 0 is for interactive
+updates, and lane 1 for bulk requests, which wait behind lane 0."""
+    if type in (Connect, Disconnect, Ping, Pong):
+        return None
+    if type in (Join, Pull, Users, Backfill, Emotes, ChannelInfo, Channels, Data):
+        return 1
+    return 0
+
+class QueuedClient(Client):
+    """A client that queues outgoing updates in its server's outbox."""
+    __slots__ = 'server', 'lane'
+
+    def __init__(self, server, username=None, password=None):
+        super().__init__(username, password)
+        self.server = server
+        self.lane = None
+        # Set up by Server.connect, pylichat leaves it unset until connect_raw.
+        self.socket = None
+
+    def send(self, type, **args):
+        self.lane = send_lane(type)
+        return super().send(type, **args)
+
+    def send_callback(self, callback, type, **args):
+        self.lane = send_lane(type)
+        return super().send_callback(callback, type, **args)
+
+    def send_raw(self, string):
+        if self.lane is None:
+            self.server.write(string, flush=True)
+        else:
+            self.server.queue_send(self.lane, string)
 
 class Server:
     def __init__(self, name=None, key=None, username=None, password=None, host='chat.tymoon.eu', port=1111, ssl=False):
-        client = Client(username, password)
+        client = QueuedClient(self, username, password)
         self.buffers = pylichat.toolkit.CaseInsensitiveDict()
         self.name = name
-        self.key = key
+        self.key = key or name
         self.client = client
         self.host = host
         self.port = port
         self.ssl = ssl
         self.hook = None
-        self.timeout = None
+        # One of disconnected, resolving, tls, handshake, connected, see connect
+        self.state = 'disconnected'
+        self.connect_hook = None
+        self.connect_deadline = None
+        self.connect_buffer = None
+        self.decoder = None
+        self.connected_at = None
+        self.reconnect_at = None
+        self.reconnect_attempts = 0
+        self.next_ping_at = None
         self.ping_sent_at = None
+        self.lag = None
+        self.lag_shown = ''
+        self.latency = LatencyHistogram()
+        self.pending = deque()
+        self.pending_hook = None
+        self.update_settings()
+        self.outbox = (deque(), deque())
+        self.write_buffer = bytearray()
+        # Updates sent while an upload is being written, see write
+        self.held_writes = bytearray()
+        self.upload = None
+        self.uploads = deque()
+        self.write_timer = None
+        self.write_blocked = None
+        self.send_tokens = self.settings.send_burst
+        self.send_refilled_at = time.monotonic()
         
         emote_dir = w.info_get('weechat_dir', '')+'/lichat/emotes/'+self.host+'/'
         w.mkdir_parents(emote_dir, 0o755)
-        client.reload_emotes(emote_dir)
+        index_emotes(client, emote_dir)
+        self.emote_dir = emote_dir
+        self.emote_index = EmoteIndex(client.emotes.keys())
+        # Kept next to, not in the emote directory, as it would be picked up as an emote.
+        self.emote_manifest_file = w.info_get('weechat_dir', '')+'/lichat/emotes/'+self.host+'.json'
+        self.emote_manifest = read_emote_manifest(self.emote_manifest_file, client.emotes)
+        self.emote_writes = []
+        self.emote_writer = None
 
         def on_connect(client, update):
-            for channel in self.config('autojoin', str, '').split('  '):
+            for channel in self.settings.autojoin.split('  '):
                 if channel != '':
                     logger.debug(f"autojoining {channel!r}")
                     self.send(Join, channel=channel)
 
         def on_disconnect(client, update):
+            if self.state not in ('connected', 'disconnected'):
+                # Lost during the connect, which then has to be aborted and retried.
+                self.connect_failed(message="Connection lost.")
+                return
+            self.clear_pending()
+            self.clear_outbox()
+            self.clear_writes()
             for channel in self.buffers:
                 self.buffers[channel].disconnect()
-            if self.timeout != None:
-                w.unhook(self.timeout)
-                self.timeout = None
+            self.state = 'disconnected'
+            self.next_ping_at = None
+            self.ping_sent_at = None
+            self.update_lag_item()
+            if self.connected_at is not None and stable_connection_time <= time.monotonic() - self.connected_at:
+                self.reconnect_attempts = 0
+            self.connected_at = None
             if self.hook != None:
                 w.unhook(self.hook)
                 self.hook = None
-                if self.config('autoreconnect', bool):
-                    cooldown = max(1, self.config('autoreconnect_delay', int))
-                    self.show(text=f"Reconnecting in {cooldown} seconds...", kind='network', show_source=False)
-                    w.hook_timer(cooldown * 1000, 1, 1, 'reconnect_cb', self.name)
+                if self.settings.autoreconnect:
+                    self.schedule_reconnect()
         
         def on_misc(client, update):
-            if self.timeout != None:
-                w.unhook(self.timeout)
-                self.timeout = None
-            if self.hook != None:
-                self.timeout = w.hook_timer(1000*60, 1, 1, 'timeout_cb', self.name)
-            
             if isinstance(update, Failure):
                 self.show(update, kind='error', tags=['irc_error', 'log3'])
 
             if self.ping_sent_at is not None and isinstance(update, Pong):
-                delta = time.monotonic() - self.ping_sent_at
-                logger.debug(f"Ping reply received after {delta} seconds")
-                if delta > 1.0:
-                    self.show(text=f"Ping reply received after {delta:.4f} seconds", kind='network', show_source=False)
+                now = time.monotonic()
+                self.lag = now - self.ping_sent_at
+                logger.debug(f"Ping reply received after {self.lag} seconds")
+                self.latency.add(self.lag)
                 self.ping_sent_at = None
+                self.next_ping_at = now + behaviour.ping_interval
+                self.update_lag_item()
 
         def on_message(client, update):
             buffer = self.show(update, kind='text', tags=['irc_privmsg', 'log1'])
@@ -632,21 +1132,23 @@ class Server:
                 self.show(update, text=f"has enabled pause mode by {update.by} in {update.channel}", show_source='bare', tags=['no_highlight', 'log3'])
 
         def on_emote(client, update):
-            self.client.emotes[update.name].offload(emote_dir)
+            emote = self.client.emotes[update.name]
+            digest = hashlib.sha256(emote.payload).hexdigest()
+            if self.emote_manifest.get(emote.name, {}).get('sha256') != digest:
+                self.emote_manifest[emote.name] = {'file': emote.filename(), 'sha256': digest}
+                self.write_emote(emote.name)
+            self.emote_index.add(update.name)
 
         def on_data(client, update):
-            data = update.__dict__
-            data['server'] = name
-            if self.client.is_my_own(update):
-                if imgur_client_id != '' and update['content-type'] in imgur_formats:
-                    w.hook_process('func:upload_file', 0, 'process_upload', json.dumps(data))
-                    self.show(update, text=f"sent file {update['filename']} (Uploading...)", show_source='bare')
-                elif data_save_directory != '' and (data_save_types == ['all'] or update['content-type'] in data_save_types):
-                    data['url'] = f"{data_save_directory}/{time.strftime('%Y.%m.%d-%H-%M-%S')}-{data['filename']}"
-                    w.hook_process('func:write_file', 0, 'process_upload', json.dumps(data))
-                    self.show(update, text=f"sent file {update['filename']} (Saving...)", show_source='bare')
-                else:
-                    self.show(update, text=f"sent file {update['filename']} ({update['content-type']})", show_source='bare')
+            own = self.client.is_my_own(update)
+            if own and imgur_client_id != '' and update['content-type'] in imgur_formats:
+                data = {'server': name, 'channel': update.channel, 'id': update.id, 'from': update['from'],
+                        'filename': update['filename'], 'content-type': update['content-type']}
+                data['client_id'] = imgur_client_id
+                transfer_pool.submit('upload_file', 'process_upload', json.dumps(data), size=len(update.payload) * 3 // 4, payload=update.payload)
+                self.show(update, text=f"sent file {update['filename']} (Uploading...)", show_source='bare')
+            elif data_save_directory != '' and (own or behaviour.data_save_incoming) and data_type_saved(update['content-type']):
+                self.save_data(update)
             else:
                 self.show(update, text=f"sent file {update['filename']} ({update['content-type']})", show_source='bare')
 
@@ -712,9 +1214,7 @@ class Server:
             self.show(update, text=f"reacted with {update.emote}", tags=['no_highlight', 'log4'], show_source='bare')
 
         def on_users(client, update):
-            buffer = self.buffers[update.channel];
-            for user in update.users:
-                buffer.join(user)
+            self.buffers[update.channel].join_all(update.users)
 
         def on_backfill(client, update):
             buffer = self.buffers[update.channel]
@@ -742,51 +1242,506 @@ class Server:
     def config(self, key, type=str, default=None, evaluate=False):
         return cfg('server', self.key+'.'+key, type, default, evaluate)
 
+    def update_settings(self):
+        self.settings = Settings('server', server_settings, prefix=self.key+'.')
+
     def highlight(self):
-        parts = self.config('highlight', str, 'username').split(',') + cfg('behaviour', 'highlight', str, '').split(',')
+        parts = self.settings.highlight.split(',') + behaviour.highlight.split(',')
         return [ self.client.username if x == 'username' else x for x in parts ]
 
     def is_supported(self, extension):
         return self.client.is_supported(extension)
 
     def is_connected(self):
-        return self.hook != None
+        """Returns true if the server is connected or in the process of connecting."""
+        return self.state != 'disconnected'
+
+    def connect(self, w_buffer=None):
+        """Start connecting to the server without blocking.
+
+DNS and TCP are handled by hook_connect (resolving), after which the
+TLS handshake (tls) and the lichat Connect exchange (handshake) are
+driven from the socket hook. Failures are reported to w_buffer, or if
+it is None, as a failed reconnect on the server buffer."""
+        if self.state != 'disconnected': return
+        self.reconnect_at = None
+        # Nothing from a previous connection may go out ahead of the Connect.
+        self.clear_writes()
+        self.state = 'resolving'
+        self.connect_buffer = w_buffer
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self.connect_deadline = time.monotonic() + behaviour.connect_timeout
+        port = self.port or (1112 if self.ssl else 1111)
+        self.connect_hook = w.hook_connect('', self.host, port, 1, 0, '', 'lichat_connect_cb', self.name)
+
+    def socket_connected(self, fd):
+        sock = socket.socket(fileno=fd)
+        sock.setblocking(False)
+        if self.ssl:
+            try:
+                context = ssl.create_default_context()
+                self.client.socket = context.wrap_socket(sock, server_hostname=self.host, do_handshake_on_connect=False)
+            except (ssl.SSLError, OSError) as e:
+                sock.close()
+                self.connect_failed(message=str(e))
+                return
+            self.state = 'tls'
+            self.tls_handshake()
+        else:
+            self.client.socket = sock
+            self.start_handshake()
 
-    def connect(self):
-        if self.hook == None:
-            self.client.connect(self.host, self.port, ssl=self.ssl)
-            self.hook = w.hook_fd(self.client.socket.fileno(), 1, 0, 1, 'lichat_socket_cb', self.name)
+    def watch_socket(self, write=False):
+        if self.hook != None:
+            w.unhook(self.hook)
+        self.hook = w.hook_fd(self.client.socket.fileno(), 1, 1 if write else 0, 1, 'lichat_socket_cb', self.name)
+
+    def tls_handshake(self):
+        try:
+            self.client.socket.do_handshake()
+        except ssl.SSLWantReadError:
+            self.watch_socket()
+        except ssl.SSLWantWriteError:
+            self.watch_socket(write=True)
+        except (ssl.SSLError, OSError) as e:
+            self.connect_failed(message=str(e))
+        else:
+            self.start_handshake()
+
+    def start_handshake(self):
+        self.state = 'handshake'
+        self.watch_socket()
+        try:
+            self.client.send(Connect, password=self.client.password or None, version=pylichat.update.version, extensions=list(pylichat.update.extensions))
+        except pylichat.ConnectionLost as e:
+            self.connect_failed(message=str(e))
+
+    def receive(self):
+        """Read whatever is available on the socket without blocking.
+
+pylichat's recv waits for the rest of a partial update, and treats a
+TLS record without application data as a lost connection, so the
+socket is read here instead. Updates that fail to parse are logged and
+skipped, except for the reply to the Connect, which fails the connect."""
+        client = self.client
+        updates = []
+        while True:
+            try:
+                data = client.socket.recv(65536)
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError, BlockingIOError):
+                break
+            except OSError:
+                logger.debug(f"[{self.name}] error reading from socket", exc_info=True)
+                data = b''
+            if not data:
+                updates.append(pylichat.update.make_instance(pylichat.update.Disconnect))
+                break
+            chunk = self.decoder.decode(data)
+            client.chunks.append(chunk)
+            if '\0' in chunk:
+                for string in client.stitch():
+                    try:
+                        (update, _i) = pylichat.client.read_update(string)
+                    except Exception as e:
+                        if self.state == 'handshake' and not updates:
+                            raise ConnectionFailed(message=f"Could not parse the reply to the Connect: {e}")
+                        logger.warning(f"[{self.name}] Skipped an update that could not be parsed: {e}")
+                        logger.debug(f"[{self.name}] unparsed update: {string!r}")
+                        continue
+                    if update != None:
+                        logger.debug(f"received {update!r}")
+                        updates.append(update)
+        return updates
+
+    def receive_handshake(self):
+        try:
+            updates = self.receive()
+        except ConnectionFailed as e:
+            self.connect_failed(message=str(e))
+            return
+        if not updates:
+            return
+        if not isinstance(updates[0], Connect):
+            self.connect_failed(update=updates[0])
+            return
+        self.state = 'connected'
+        self.connected_at = time.monotonic()
+        self.next_ping_at = self.connected_at + behaviour.ping_interval
+        self.connect_deadline = None
+        self.connect_buffer = None
+        self.pending.extend(updates)
+        self.handle_pending()
+        if self.uploads and self.upload == None:
+            self.pump_upload()
+            self.try_flush_writes()
+
+    def abort_connect(self):
+        if self.connect_hook != None:
+            w.unhook(self.connect_hook)
+            self.connect_hook = None
+        if self.hook != None:
+            w.unhook(self.hook)
+            self.hook = None
+        self.clear_outbox()
+        self.clear_writes()
+        self.client.disconnect_raw()
+        self.state = 'disconnected'
+        self.connect_deadline = None
+
+    def connect_failed(self, update=None, message='Connection failed.'):
+        self.abort_connect()
+        error = ConnectionFailed(update=update, message=message)
+        w_buffer = self.connect_buffer
+        self.connect_buffer = None
+        if w_buffer != None:
+            show_connect_failure(w_buffer, self, error)
+            return
+        self.show(text=f"Reconnect failed: {error}", kind='error', show_source=False)
+        if self.settings.autoreconnect:
+            if (isinstance(update, InvalidPassword)
+                or isinstance(update, NoSuchProfile)
+                or isinstance(update, BadName)
+                or isinstance(update, IncompatibleVersion)):
+                # don't try to reconnect again under sufficiently bad conditions
+                return
+            self.schedule_reconnect()
+
+    def schedule_reconnect(self):
+        """Schedule the next reconnect attempt, picked up by tick.
+
+The delay starts at autoreconnect_delay and doubles with every attempt
+up to autoreconnect_max_delay. It is then randomised down to half, so
+that servers that dropped at the same time do not retry in lockstep.
+The attempts are only forgotten once a connection has stayed up for
+stable_connection_time."""
+        base = max(1, self.settings.autoreconnect_delay)
+        cap = max(base, self.settings.autoreconnect_max_delay)
+        delay = min(cap, base * 2 ** min(self.reconnect_attempts, 16))
+        delay *= random.uniform(0.5, 1.0)
+        self.reconnect_attempts += 1
+        self.reconnect_at = time.monotonic() + delay
+        self.show(text=f"Reconnecting in {delay:.0f} seconds...", kind='network', show_source=False)
 
     def disconnect(self):
-        if self.timeout != None:
-            w.unhook(self.timeout)
-            self.timeout = None
+        self.next_ping_at = None
+        self.ping_sent_at = None
+        self.reconnect_at = None
+        self.clear_pending()
+        self.clear_outbox()
+        if self.state != 'connected':
+            if self.state != 'disconnected':
+                self.abort_connect()
+                self.connect_buffer = None
+            return
+        self.state = 'disconnected'
         if self.hook != None:
             w.unhook(self.hook)
             self.hook = None
-            self.client.disconnect()
+            if self.cancel_uploads('Upload interrupted:'):
+                # The Disconnect could only follow the rest of the Data
+                # update, so the connection is dropped instead.
+                self.client.disconnect_raw()
+                self.disconnected_error()
+            else:
+                self.client.disconnect()
+        self.clear_writes()
 
     def disconnected_error(self):
         logger.debug(f"[{self.name}] disconnected_error")
         self.client.handle(pylichat.update.make_instance(pylichat.update.Disconnect))
 
-    def reconnect(self):
-        if self.hook != None: return
+    def write_emote(self, name):
+        """Queue an emote to be written to disk by a background process.
+
+Emotes arriving in the same burst are written by a single process, and
+only one such process runs per server at a time."""
+        self.emote_writes.append(name)
+        if self.emote_writer == None:
+            self.emote_writer = w.hook_timer(1, 0, 1, 'emote_write_cb', self.name)
+
+    def start_emote_writer(self):
+        data = {'server': self.name, 'names': self.emote_writes}
+        self.emote_writes = []
+        self.emote_writer = w.hook_process('func:write_emotes', 0, 'process_emotes', json.dumps(data))
+
+    def save_data(self, update):
+        """Save a Data update's payload to the data store and show its link.
+
+The payload is handed to a transfer worker as it is, which decodes and
+hashes it, and only writes it if the store does not hold it already."""
+        store = get_data_store()
+        data = {'server': self.name, 'channel': update.channel, 'id': update.id, 'from': update['from'],
+                'filename': update['filename'], 'content-type': update['content-type'],
+                'key': f"{self.name}/{update.id}", 'directory': store.directory,
+                'suffix': blob_suffix(update['filename'], update['content-type'])}
+        transfer_pool.submit('store_file', 'process_store', json.dumps(data), size=len(update.payload) * 3 // 4, payload=update.payload)
+        self.show(update, text=f"sent file {update['filename']} (Saving...)", show_source='bare')
+
+    def handle_pending(self):
+        """Handle received updates until the receive budget is used up.
+
+Whatever is left over is handled from a short timer, so that WeeChat
+can process input in between."""
+        deadline = time.monotonic() + behaviour.receive_time_budget / 1000
+        budget = behaviour.receive_update_budget
         try:
-            self.show(text='Reconnecting...', kind='network', show_source=False)
-            self.connect()
-        except ConnectionFailed as e:
-            self.show(text=f"Reconnect failed: {e.update.text}", kind='error', show_source=False)
-            if self.config('autoreconnect', bool):
-                if (isinstance(e.update, InvalidPassword)
-                    or isinstance(e.update, NoSuchProfile)
-                    or isinstance(e.update, BadName)
-                    or isinstance(e.update, IncompatibleVersion)):
-                    # don't try to reconnect again under sufficiently bad conditions
-                    return
-                cooldown = max(1, self.config('autoreconnect_delay', int))
-                self.show(text=f"Reconnecting in {cooldown} seconds...", kind='network', show_source=False)
-                w.hook_timer(cooldown * 1000, 1, 1, 'reconnect_cb', self.name)
+            while self.pending and 0 < budget:
+                budget -= 1
+                self.client.handle(self.pending.popleft())
+                if deadline <= time.monotonic():
+                    break
+        except pylichat.ConnectionLost:
+            logger.info(f"[{self.name}] connection lost", exc_info=True)
+            self.disconnected_error()
+        except Exception as e:
+            logger.exception(f"[{self.name}] error while handling updates")
+
+        if self.pending and self.pending_hook == None:
+            self.pending_hook = w.hook_timer(1, 0, 1, 'lichat_pending_cb', self.name)
+
+    def clear_pending(self):
+        self.pending.clear()
+        if self.pending_hook != None:
+            w.unhook(self.pending_hook)
+            self.pending_hook = None
+
+    def queue_send(self, lane, string):
+        self.outbox[lane].append(string)
+        self.flush_outbox()
+
+    def flush_outbox(self):
+        """Write queued updates for as long as the send rate allows.
+
+The rate is a token bucket refilled at send_rate updates per second,
+holding at most send_burst. Interactive updates go out before bulk ones.
+Nothing is written before the server has accepted the Connect."""
+        if self.state != 'connected': return
+        now = time.monotonic()
+        self.send_tokens = min(self.settings.send_burst, self.send_tokens + (now - self.send_refilled_at) * self.settings.send_rate)
+        self.send_refilled_at = now
+        queued = self.outbox_depth()
+        try:
+            for lane in self.outbox:
+                while lane and 1 <= self.send_tokens:
+                    self.send_tokens -= 1
+                    self.write(lane.popleft())
+        except pylichat.ConnectionLost:
+            logger.info(f"[{self.name}] connection lost", exc_info=True)
+            self.disconnected_error()
+        if queued != self.outbox_depth():
+            w.bar_item_update('lichat_outbox')
+
+    def outbox_depth(self):
+        return len(self.outbox[0]) + len(self.outbox[1])
+
+    def clear_outbox(self):
+        if self.outbox_depth():
+            self.outbox[0].clear()
+            self.outbox[1].clear()
+            w.bar_item_update('lichat_outbox')
+
+    def write(self, string, flush=False):
+        """Buffer a serialized update to be written to the socket.
+
+The buffer is written from a one-shot timer, so every update sent
+during one callback goes out in a single write. It is written straight
+away if flush is true or it has grown past write_flush_size."""
+        if self.upload != None:
+            self.held_writes += string.encode('utf-8') + b'\0'
+            return
+        self.write_buffer += string.encode('utf-8') + b'\0'
+        if flush or write_flush_size <= len(self.write_buffer):
+            self.flush_writes()
+        elif self.write_timer == None:
+            self.write_timer = w.hook_timer(1, 0, 1, 'lichat_write_cb', self.name)
+
+    def flush_writes(self):
+        """Write as much of the write buffer as the socket takes without blocking.
+
+What the socket does not take is written once it becomes writable."""
+        if self.write_timer != None:
+            w.unhook(self.write_timer)
+            self.write_timer = None
+        sock = self.client.socket
+        if self.write_blocked != None or sock is None:
+            return
+        try:
+            while self.write_buffer:
+                sent = sock.send(self.write_buffer)
+                if sent == 0: break
+                del self.write_buffer[:sent]
+        except (BlockingIOError, ssl.SSLWantWriteError, ssl.SSLWantReadError):
+            pass
+        except OSError:
+            self.client.disconnect_raw()
+            raise pylichat.ConnectionLost("send error")
+        if self.write_buffer or self.upload != None or (self.uploads and self.state == 'connected'):
+            self.write_blocked = w.hook_fd(sock.fileno(), 0, 1, 0, 'lichat_writable_cb', self.name)
+
+    def try_flush_writes(self):
+        try:
+            self.flush_writes()
+        except pylichat.ConnectionLost:
+            logger.info(f"[{self.name}] connection lost", exc_info=True)
+            self.disconnected_error()
+
+    def clear_writes(self):
+        self.cancel_uploads('Upload interrupted:')
+        self.write_buffer.clear()
+        self.held_writes.clear()
+        if self.write_timer != None:
+            w.unhook(self.write_timer)
+            self.write_timer = None
+        if self.write_blocked != None:
+            w.unhook(self.write_blocked)
+            self.write_blocked = None
+
+    def queue_upload(self, upload):
+        """Queue a file to be sent, once the server has accepted the Connect."""
+        if self.state == 'disconnected':
+            upload.show("Failed to send file: Not connected to the server:")
+            upload.close()
+            return
+        self.uploads.append(upload)
+        if self.upload == None:
+            self.pump_upload()
+            self.try_flush_writes()
+
+    def start_upload(self):
+        """Start writing the next queued upload, returning false if there is none."""
+        if self.state != 'connected':
+            return False
+        while self.uploads:
+            upload = self.uploads.popleft()
+            try:
+                upload.open()
+            except OSError as e:
+                upload.show(f"Failed to send file: {e.strerror}:")
+                upload.close()
+                continue
+            update = upload.update
+            def callback(client, sent, reply):
+                if isinstance(reply, Failure):
+                    upload.show(f"Failed to send file: {reply.text}:")
+            self.client.in_flight[update.id] = update
+            self.client.callbacks[update.id] = (callback, update)
+            # The payload goes last and is streamed in by pump_upload.
+            head = pylichat.wire.to_string(update.to_list())[:-1] + ' :payload "'
+            self.write_buffer += head.encode('utf-8')
+            self.upload = upload
+            upload.show_progress()
+            return True
+        return False
+
+    def pump_upload(self):
+        """Encode more of the current upload into the write buffer.
+
+Only tops the write buffer up to write_flush_size, the rest follows
+once the socket has taken that. Other updates sent in the meantime are
+held back until the Data update is complete, as it cannot be split."""
+        if self.upload == None and not self.start_upload():
+            return
+        upload = self.upload
+        while len(self.write_buffer) < write_flush_size:
+            try:
+                chunk = upload.read()
+            except OSError as e:
+                # The Data update cannot be finished, so the connection has to go.
+                self.upload = None
+                upload.show(f"Failed to send file: {e.strerror}:")
+                upload.close()
+                self.restart("Failed to read a file being sent, reconnecting...")
+                return
+            if chunk:
+                self.write_buffer += chunk
+                continue
+            self.write_buffer += b'")\0'
+            self.write_buffer += self.held_writes
+            self.held_writes.clear()
+            self.upload = None
+            upload.close()
+            upload.show("Sent file")
+            return
+        upload.show_progress()
+
+    def cancel_uploads(self, text='Cancelled:'):
+        """Cancel all uploads, returning whether one was partly written already."""
+        for upload in self.uploads:
+            upload.show(text)
+            upload.close()
+        self.uploads.clear()
+        upload = self.upload
+        if upload == None:
+            return False
+        self.upload = None
+        self.write_buffer += self.held_writes
+        self.held_writes.clear()
+        upload.show(text)
+        upload.close()
+        return True
+
+    def tick(self, now):
+        if self.state == 'connected' and (self.outbox[0] or self.outbox[1]):
+            self.flush_outbox()
+        if self.reconnect_at is not None and self.reconnect_at <= now:
+            self.reconnect()
+        if self.connect_deadline is not None and self.connect_deadline <= now:
+            self.connect_failed(message='Timeout')
+        # A ping would be held back behind the upload and only measure that.
+        if self.next_ping_at is not None and self.next_ping_at <= now and self.upload == None:
+            self.ping(now)
+        if self.ping_sent_at is not None:
+            if behaviour.lag_reconnect <= now - self.ping_sent_at:
+                self.lag_timeout(now - self.ping_sent_at)
+            else:
+                self.update_lag_item()
+        for buffer in list(self.buffers.values()):
+            if buffer.backfill_deadline is not None and buffer.backfill_deadline <= now:
+                buffer.backfill_timeout()
+
+    def ping(self, now):
+        logger.debug(f"[{self.name}] sending ping")
+        self.next_ping_at = None
+        self.ping_sent_at = now
+        self.send(Ping)
+
+    def lag_timeout(self, lag):
+        logger.debug(f"[{self.name}] no ping reply after {lag} seconds, reconnecting")
+        self.restart(f"No ping reply for {lag:.0f} seconds, reconnecting...")
+
+    def restart(self, text):
+        """Drop the connection without a Disconnect exchange and reconnect straight away."""
+        self.show(text=text, kind='network', show_source=False)
+        # Unhooked first so that on_disconnect leaves the reconnect to us.
+        if self.hook != None:
+            w.unhook(self.hook)
+            self.hook = None
+        self.disconnected_error()
+        self.reconnect()
+
+    def current_lag(self):
+        """Returns the last round-trip time, or the time waited on the current ping if longer."""
+        if self.ping_sent_at is not None:
+            return max(self.lag or 0, time.monotonic() - self.ping_sent_at)
+        return self.lag
+
+    def lag_text(self):
+        lag = self.current_lag()
+        if self.state != 'connected' or lag is None or lag * 1000 < behaviour.lag_min_show:
+            return ''
+        return f"Lag: {lag:.1f}"
+
+    def update_lag_item(self):
+        text = self.lag_text()
+        if text != self.lag_shown:
+            self.lag_shown = text
+            w.bar_item_update('lichat_lag')
+
+    def reconnect(self):
+        self.reconnect_at = None
+        if self.state != 'disconnected': return
+        self.show(text='Reconnecting...', kind='network', show_source=False)
+        self.connect()
 
     def delete(self):
         self.client.disconnect()
@@ -794,6 +1749,8 @@ class Server:
         del servers[name]
 
     def send(self, type, **args):
+        if self.state != 'connected':
+            return self.show_not_connected(args.get('channel'))
         try:
             return self.client.send(type, **args)
         except pylichat.ConnectionLost:
@@ -801,13 +1758,25 @@ class Server:
             self.disconnected_error()
 
     def send_cb(self, cb, type, **args):
+        if self.state != 'connected':
+            return self.show_not_connected(args.get('channel'))
         try:
             return self.client.send_callback(cb, type, **args)
         except pylichat.ConnectionLost:
             logger.info(f"[{self.name}] connection lost", exc_info=True)
             self.disconnected_error()
 
-    def show(self, update=None, text=None, kind='action', tags=[], show_source=True, buffer=None):
+    def show_not_connected(self, channel=None):
+        buffer = None
+        for name in (channel, self.client.servername):
+            if buffer == None and name != None:
+                buffer = self.buffers.get(name, None)
+        if buffer != None:
+            buffer.show(text="Not connected to the server.", kind='error')
+        else:
+            w.prnt("", f"{w.prefix('error')}[{self.name}] Not connected to the server.")
+
+    def show(self, update=None, text=None, kind='action', tags=(), show_source=True, buffer=None):
         if buffer == None and isinstance(update, UpdateFailure):
             origin = self.client.origin(update)
             if origin != None and not isinstance(origin, Leave) and not isinstance(origin, Join):
@@ -824,6 +1793,11 @@ class Server:
         return buffer.show(update=update, text=text, kind=kind, tags=tags, show_source=show_source)
 
 ### Commands
+def split_args(string):
+    """Split command arguments like a shell, importing shlex on first use."""
+    import shlex
+    return shlex.split(string)
+
 def check_signature(f, args, command=None):
     sig = signature(f)
     try:
@@ -846,7 +1820,7 @@ def raw_command(name, completion='', description=''):
         def wrapper(_data, w_buffer, args_str):
             args = args_str
             if isinstance(args, str):
-                args = shlex.split(args)
+                args = split_args(args)
             args.pop(0)
             if check_signature(f, [w_buffer, *args], command=name):
                 f(w_buffer, *args)
@@ -866,7 +1840,7 @@ def lichat_command(name, completion='', description=''):
                 return w.WEECHAT_RC_OK
             args = args_str
             if isinstance(args, str):
-                args = shlex.split(args)
+                args = split_args(args)
             args.pop(0)
             if check_signature(f, [buffer, *args], command=name):
                 f(buffer, *args)
@@ -888,7 +1862,7 @@ def handle_failure(buffer):
     return nested
 
 def lichat_command_cb(data, w_buffer, args_str):
-    args = shlex.split(args_str)
+    args = split_args(args_str)
     if len(args) == 0:
         return w.WEECHAT_RC_ERROR
 
@@ -904,20 +1878,21 @@ def lichat_command_cb(data, w_buffer, args_str):
 
     return command['func'](data, w_buffer, args)
 
+def show_connect_failure(w_buffer, server, e):
+    if isinstance(e.update, InvalidPassword):
+        w.prnt(w_buffer, f"{w.prefix('error')}[{server.name}] The password is invalid!")
+    elif isinstance(e.update, NoSuchProfile):
+        w.prnt(w_buffer, f"{w.prefix('error')}[{server.name}] The given username is not registered and does not require a password!")
+    elif isinstance(e.update, TooManyConnections):
+        w.prnt(w_buffer, f"{w.prefix('error')}[{server.name}] The server has too many connections and refused yours.")
+    elif isinstance(e.update, TextUpdate):
+        w.prnt(w_buffer, f"{w.prefix('error')}[{server.name}] Failed to connect: {e.update.text}")
+    else:
+        w.prnt(w_buffer, f"{w.prefix('error')}[{server.name}] Failed to connect: {e}")
+
 def try_connect(w_buffer, server):
     try:
-        server.connect()
-    except ConnectionFailed as e:
-        if isinstance(e.update, InvalidPassword):
-            w.prnt(w_buffer, f"{w.prefix('error')}[{server.name}] The password is invalid!")
-        elif isinstance(e.update, NoSuchProfile):
-            w.prnt(w_buffer, f"{w.prefix('error')}[{server.name}] The given username is not registered and does not require a password!")
-        elif isinstance(e.update, TooManyConnections):
-            w.prnt(w_buffer, f"{w.prefix('error')}[{server.name}] The server has too many connections and refused yours.")
-        elif isinstance(e.update, TextUpdate):
-            w.prnt(w_buffer, f"{w.prefix('error')}[{server.name}] Failed to connect: {e.update.text}")
-        else:
-            w.prnt(w_buffer, f"{w.prefix('error')}[{server.name}] Failed to connect: {e}")
+        server.connect(w_buffer)
     except Exception as e:
         logger.exception(f"[{server.name}] Failed to connect to {server.host}:{server.port} {'with SSL' if server.ssl else ''}")
 
@@ -944,7 +1919,8 @@ def connect_command_cb(w_buffer, name=None, host=None, port=None, username=None,
         if ssl == None: ssl = cfg('server_default', 'ssl', bool)
         if ssl == 'on': ssl = True
         if ssl == 'off': ssl = False
-        try_connect(w_buffer, Server(name=name, username=username, password=evaluate_string(password), host=host, port=port, ssl=ssl))
+        server = Server(name=name, username=username, password=evaluate_string(password), host=host, port=port, ssl=ssl)
+        try_connect(w_buffer, server)
         config_section(config_file, 'server', [
             {'name': f'{name}.host', 'default': host},
             {'name': f'{name}.port', 'default': port, 'min': 1, 'max': 65535},
@@ -954,6 +1930,7 @@ def connect_command_cb(w_buffer, name=None, host=None, port=None, username=None,
             {'name': f'{name}.autoconnect', 'default': True},
             {'name': f'{name}.autojoin', 'default': ''}
         ])
+        server.update_settings()
     elif name not in servers:
         w.prnt(w_buffer, f"{w.prefix('error')} No such server {name}")
     else:
@@ -969,6 +1946,38 @@ def disconnect_command_cb(buffer, server=None):
     server.disconnect()
     config_updated(full=False)
 
+@raw_command('servers', '', 'List the lichat servers, their connection state, and when the next reconnect attempt is due.')
+def servers_command_cb(w_buffer):
+    now = time.monotonic()
+    for server in servers.values():
+        status = server.state
+        if server.reconnect_at is not None:
+            status += f", reconnecting in {max(0, server.reconnect_at - now):.0f}s (attempt {server.reconnect_attempts})"
+        if server.outbox_depth():
+            status += f", {len(server.outbox[0])} interactive and {len(server.outbox[1])} bulk updates queued"
+        w.prnt(w_buffer, f"lichat: {server.name} ({server.host}:{server.port}): {status}")
+
+@raw_command('lag', '%(lichat_server)', 'Show the lag to a lichat server and the distribution of recent ping round-trips. If no server name is passed, the server of the current buffer is used, or all servers outside of lichat buffers.')
+def lag_command_cb(w_buffer, name=None):
+    if name != None:
+        if name not in servers:
+            w.prnt(w_buffer, f"{w.prefix('error')}lichat: No such server {name}")
+            return
+        shown = [servers[name]]
+    else:
+        buffer = weechat_buffer_to_representation(w_buffer)
+        shown = [buffer.server] if buffer != None else list(servers.values())
+    for server in shown:
+        lag = server.current_lag()
+        if lag is None:
+            w.prnt(w_buffer, f"lichat: {server.name}: no lag measured yet")
+            continue
+        (p50, p95, p99) = server.latency.percentiles(50, 95, 99) or (lag, lag, lag)
+        w.prnt(w_buffer, f"lichat: {server.name}: lag {lag:.3f}s, p50 {p50:.3f}s, p95 {p95:.3f}s, p99 {p99:.3f}s over {len(server.latency)} pings")
+        buckets = [f"{'<' + format(bound, 'g') + 's' if bound else 'more'}: {count}" for (bound, count) in server.latency.buckets() if count]
+        if buckets:
+            w.prnt(w_buffer, f"lichat: {server.name}: {', '.join(buckets)}")
+
 @raw_command('help', '%(lichat_command) %-', 'Display help information about lichat commands.')
 def help_command_cb(w_buffer, topic=None):
     if topic == None:
@@ -1155,17 +2164,45 @@ def deny_command_cb(buffer, update, target=None, channel=None):
         buffer.send_confirm(f"{target} has been denied from {update}ing",
                             Deny, channel=channel, target=target, update=type)
 
-@lichat_command('send', '%(filename) %(lichat_channel) %-', 'Send a local file or file from an URL as a data upload. If no channel name is given, defaults to the current channel.')
-def send_command_cb(buffer, file, channel=None):
+@lichat_command('send', '%(filename)|%(lichat_channel) %*', 'Send local files, globs such as ~/shots/*.png, or files from URLs as data uploads. Several may be given at once. URLs are downloaded in parallel by the transfer workers, and files are sent one after the other, each with its own progress line. If the last argument is not a file or URL, it is the channel to send to, which defaults to the current channel.')
+def send_command_cb(buffer, source, *sources):
+    sources = [source, *sources]
+    channel = None
+    if 1 < len(sources) and not re.match('^(\\w:|/|~|\\w+://)', sources[-1]):
+        channel = sources.pop()
+    for source in sources:
+        if re.match('^(\\w:|/|~)', source):
+            path = os.path.expanduser(source)
+            if re.search('[*?[]', path):
+                import glob
+                paths = sorted(p for p in glob.glob(path) if os.path.isfile(p))
+                if not paths:
+                    buffer.show(text=f"No files match {source}", kind='error')
+                for path in paths:
+                    send_file(buffer, path, channel)
+            else:
+                send_file(buffer, path, channel)
+        else:
+            send_url(buffer, source, channel)
+
+def send_file(buffer, path, channel=None):
+    (content_type, _) = mimetypes.guess_type(path, False)
+    update = buffer.make_instance(Data, channel=channel, filename=Path(path).stem, **{'content-type': content_type})
+    buffer.show(update, text=f"Waiting to send file {update['filename']}")
+    buffer.server.queue_upload(Upload(buffer, update, path))
+
+def send_url(buffer, url, channel=None):
     update = buffer.make_instance(Data, channel=channel)
-    data = update.__dict__
-    data['server'] = buffer.server.name
-    data['url'] = file
-    if re.match('^(\\w:|/|~)', file):
-        w.hook_process('func:read_file', 0, 'process_send', json.dumps(data))
-    else:
-        w.hook_process('func:download_file', 0, 'process_send', json.dumps(data))
-    buffer.show(update, text=f"Sending file...")
+    data = {'server': buffer.server.name, 'channel': update.channel, 'id': update.id, 'from': update['from'], 'url': url,
+            'max_size': behaviour.download_max_size * 1024 * 1024, 'timeout': behaviour.download_timeout}
+    transfer_pool.submit('download_file', 'process_send', json.dumps(data), progress='transfer_progress')
+    buffer.show(update, text=f"Waiting to download {url}")
+
+@lichat_command('cancel', '', 'Cancel the file uploads to the current server. An upload that is already being sent can only be stopped by reconnecting.')
+def cancel_command_cb(buffer):
+    server = buffer.server
+    if server.cancel_uploads():
+        server.restart("Cancelled an upload in progress, reconnecting...")
 
 @lichat_command('capabilities', '%(lichat_channel) %-', 'Check what capabilities you have. If no channel name is given, defaults to the current channel.')
 def capabilities_command_cb(buffer, channel=None):
@@ -1188,45 +2225,26 @@ def server_info_command_cb(buffer, target):
 """)
     buffer.send_cb(callback, ServerInfo, target=target)
 
+@raw_command('startup', '', 'Show how long loading the script took, per phase.')
+def startup_command_cb(w_buffer):
+    w.prnt(w_buffer, f"lichat: {startup_report}")
+
 @lichat_command('edit', '1', 'Edit a previous message.')
 def edit_command_cb(buffer, line=None, *text):
     if line == None:
         pass # TODO: interactive edit selection
     else:
-        text = ''
         if line.isdigit():
             line = int(line)
             text = ' '.join(text)
         else:
             text = line+' '+' '.join(text)
             line = 1
-        source = 'lichat_from_'+buffer.server.client.username
-        message = 'lichat_type_message'
-        seen_ids = ['']
-        def matcher(h_line, h_line_data, line):
-            found_source = False
-            found_message = False
-            id = None
-            data = w.hdata_pointer(h_line, line, 'data')
-            for i in range(w.hdata_integer(h_line_data, data, 'tags_count')):
-                tag = w.hdata_string(h_line_data, data, f"{i}|tags_array")
-                if tag == source: found_source = True
-                if tag == message: found_message = True
-                if tag.startswith('lichat_id_'): id = tag[10:]
-            ## If this is ours, check.
-            if found_source and found_message and id != None:
-                ## If this is a new ID, append it to the stack.
-                if seen_ids[-1] != id:
-                    seen_ids.append(id)
-            ## If we've now reached the first message of the ones we want, we're good to go.
-            return len(seen_ids)+1 == line
-        
-        ## Last ID is now ID we want
-        search_buffer(buffer.buffer, matcher, gather=False)
-        if line < len(seen_ids):
-            buffer.send(Edit, id=int(seen_ids[line]), text=text)
+        if 0 < line <= len(buffer.own_messages):
+            (id, _) = buffer.own_messages[-line]
+            buffer.send(Edit, id=int(id), text=text)
         else:
-            buffer.show(text=f"Only found {len(seen_ids)-1} messages from you. Don't know how to access message {line-1}.", kind='error')
+            buffer.show(text=f"Only found {len(buffer.own_messages)} messages from you. Don't know how to access message {line}.", kind='error')
 
 @lichat_command('react', '1 %(lichat_emote)', 'React to a previous message. Can use emotes or Unicode emoji.')
 def react_command_cb(buffer, line=None, *text):
@@ -1239,31 +2257,12 @@ def react_command_cb(buffer, line=None, *text):
         else:
             text = line+(' '+' '.join(text) if 0<len(text) else '')
             line = 1
-        found = 0
-        message = (None, None)
-        def matcher(h_line, h_line_data, line):
-            nonlocal found, message
-            found_message = False
-            id = None
-            fr = None
-            data = w.hdata_pointer(h_line, line, 'data')
-            for i in range(w.hdata_integer(h_line_data, data, 'tags_count')):
-                tag = w.hdata_string(h_line_data, data, f"{i}|tags_array")
-                if tag == 'lichat_type_message': found_message = True
-                if tag.startswith('lichat_id_'): id = tag[10:]
-                if tag.startswith('lichat_from_'): fr = tag[12:]
-            if found_message and id != None and fr != None:
-                found += 1
-                message = (id, fr)
-            return found == line
-        
-        search_buffer(buffer.buffer, matcher, gather=False)
-        (id, fr) = message
-        if id != None:
+        if 0 < line <= len(buffer.messages):
+            (id, fr) = buffer.messages[-line]
             data = {'update-id': int(id), 'target': fr, 'emote': text}
             buffer.send(React, **data)
         else:
-            buffer.show(text=f"Only found {found} messages. Don't know how to access message {line}.", kind='error')
+            buffer.show(text=f"Only found {len(buffer.messages)} messages. Don't know how to access message {line}.", kind='error')
 
 
 @lichat_command('query', '%(nicks) %*', 'Join a private channel with a number of other users.')
@@ -1309,107 +2308,551 @@ def send_as_command_cb(buffer, user, *text):
     buffer.send(Message, bridge=user, text=' '.join(text))
 
 ### Async
-def read_file(data):
-    data = json.loads(data)
-    try:
-        with open(data['url'], 'rb') as file:
-            data['payload'] = str(base64.b64encode(file.read()), 'utf-8')
-        (content_type, _) = mimetypes.guess_type(data['url'], False)
-        data['content-type'] = content_type
-        data['filename'] = Path(data['url']).stem
+def data_type_saved(content_type):
+    """Whether files of the content type should be saved, per data_save_types.
+
+Entries may be wildcards such as image/*, and 'all' matches any type."""
+    return any(pattern == 'all' or fnmatchcase(content_type, pattern) for pattern in data_save_types)
+
+def blob_suffix(filename, content_type):
+    """Returns the file extension to give a data store blob."""
+    suffix = Path(filename).suffix
+    if not re.fullmatch(r'\.\w{1,10}', suffix):
+        suffix = mimetypes.guess_extension(content_type) or ''
+    return suffix
+
+class DataStore:
+    """Content-addressed store of saved Data files.
+
+Each distinct file is written once, to blobs/ under the store directory,
+named by the SHA-256 hash of its content. index.json records the size and
+last use of every blob, and which blob each saved update (server/id)
+refers to, with its filename and content type, for the last
+data_index_size updates. Once the blobs exceed data_save_max_size, the
+least recently used ones are deleted."""
+    def __init__(self, directory):
+        self.directory = directory
+        self.index_file = directory+'/index.json'
+        # hash -> {'file', 'size', 'used'}, in order of last use
+        self.blobs = OrderedDict()
+        # server/id -> {'sha256', 'filename', 'content-type'}, oldest first
+        self.updates = OrderedDict()
+        self.size = 0
+        self.save_timer = None
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.index_file, 'r') as file:
+                index = json.load(file)
+        except (OSError, ValueError):
+            index = {}
+        blobs = sorted(index.get('blobs', {}).items(), key=lambda item: item[1]['used'])
+        for (digest, blob) in blobs:
+            if os.path.exists(self.directory+'/'+blob['file']):
+                self.blobs[digest] = blob
+                self.size += blob['size']
+        self.updates = OrderedDict((key, entry) for key, entry in index.get('updates', {}).items()
+                                   if entry['sha256'] in self.blobs)
+
+    def path(self, digest):
+        return self.directory+'/'+self.blobs[digest]['file']
+
+    def add(self, key, digest, size, filename, content_type, file=None):
+        """Record an update's file in the store.
+
+The blob has to be written already, to file if it is new to the store;
+for a known blob only its last use is updated."""
+        if digest in self.blobs:
+            self.blobs.move_to_end(digest)
+        else:
+            self.blobs[digest] = {'file': file, 'size': size}
+            self.size += size
+        self.blobs[digest]['used'] = time.time()
+        self.updates[key] = {'sha256': digest, 'filename': filename, 'content-type': content_type}
+        while len(self.updates) > data_index_size:
+            self.updates.popitem(last=False)
+        self.evict(digest)
+        self.save_later()
+
+    def discard(self, digest):
+        """Forget a blob and the updates referring to it, deleting its file."""
+        blob = self.blobs.pop(digest, None)
+        if blob == None:
+            return
+        self.size -= blob['size']
+        try:
+            os.unlink(self.directory+'/'+blob['file'])
+        except OSError:
+            pass
+        self.updates = OrderedDict((key, entry) for key, entry in self.updates.items() if entry['sha256'] != digest)
+        self.save_later()
+
+    def evict(self, keep=None):
+        """Delete least recently used blobs until the store fits data_save_max_size."""
+        budget = behaviour.data_save_max_size * 1024 * 1024
+        if budget <= 0:
+            return
+        for digest in list(self.blobs):
+            if self.size <= budget:
+                break
+            if digest != keep:
+                logger.debug(f"Evicting saved file {self.blobs[digest]['file']}")
+                self.discard(digest)
+
+    def save_later(self):
+        if self.save_timer == None:
+            self.save_timer = w.hook_timer(1000, 0, 1, 'data_store_save_cb', '')
+
+    def save(self):
+        if self.save_timer != None:
+            w.unhook(self.save_timer)
+            self.save_timer = None
+        try:
+            with open(self.index_file+'.tmp', 'w') as file:
+                json.dump({'blobs': self.blobs, 'updates': self.updates}, file)
+            os.replace(self.index_file+'.tmp', self.index_file)
+        except OSError as e:
+            logger.warning(f"Failed to write the data store index: {e}")
+
+def get_data_store():
+    """Return the data store for data_save_directory, loading it if needed."""
+    global data_store
+    directory = data_save_directory.rstrip('/')
+    if data_store == None or data_store.directory != directory:
+        if data_store != None and data_store.save_timer != None:
+            data_store.save()
+        data_store = DataStore(directory)
+    return data_store
+
+def data_store_save_cb(_data, _remaining):
+    if data_store != None:
+        data_store.save_timer = None
+        data_store.save()
+    return w.WEECHAT_RC_OK
 
-        buffer = find_buffer(data['server'], data['channel'])
-        if buffer != None:
-            buffer.send(Data, **data)
-        data['payload'] = True
-    except Exception as e:
-        data['text'] = f"Internal error: {e}"
-    return json.dumps(data)
+def download_file(data, progress=None):
+    """Download a URL to a temporary file, for process_send to upload from.
 
-def download_file(data):
+The body is streamed to the file in chunks. The download is abandoned
+as soon as it exceeds max_size, or up front if its Content-Length does.
+The timeout applies to connecting and to every read."""
+    import urllib.request
+    import tempfile
     data = json.loads(data)
+    max_size = data.pop('max_size')
     try:
-        r = urllib.request.urlopen(data['url'])
-        data['payload'] = str(base64.b64encode(r.read()), 'utf-8')
+        r = urllib.request.urlopen(data['url'], timeout=data.pop('timeout'))
+        length = int(r.headers.get('content-length') or 0)
+        if max_size < length:
+            data['text'] = f"File too large: {format_size(length)}, the limit is {format_size(max_size)}"
+            return json.dumps(data)
+        with tempfile.NamedTemporaryFile(prefix='lichat-', delete=False) as file:
+            data['path'] = file.name
+            size = 0
+            reported_at = time.monotonic()
+            while True:
+                chunk = r.read(65536)
+                if not chunk: break
+                size += len(chunk)
+                if max_size < size:
+                    data['text'] = f"File too large: over the limit of {format_size(max_size)}"
+                    break
+                file.write(chunk)
+                if progress != None and 0.5 <= time.monotonic() - reported_at:
+                    reported_at = time.monotonic()
+                    if length:
+                        progress(f"Downloading file... {format_size(size)} of {format_size(length)} ({100 * size // length}%)")
+                    else:
+                        progress(f"Downloading file... {format_size(size)}")
+        if 'text' in data:
+            os.unlink(data.pop('path'))
+            return json.dumps(data)
         data['content-type'] = r.headers.get('content-type').split(';')[0]
         match = re.compile('filename="([^"]+)"').search(r.headers.get('content-disposition') or '')
         if match != None:
             data['filename'] = match.group(1)
         else:
             data['filename'] = data['url'].rsplit('/', 1)[1]
-
-        buffer = find_buffer(data['server'], data['channel'])
-        if buffer != None:
-            buffer.send(Data, **data)
-        data['payload'] = True
     except urllib.error.HTTPError as e:
         data['text'] = f"URL unreachable: {e}"
+    except urllib.error.URLError as e:
+        data['text'] = f"URL unreachable: {e.reason}"
+    except socket.timeout:
+        data['text'] = "Download timed out"
     except Exception as e:
         data['text'] = f"Internal error: {e}"
+    if 'text' in data and 'path' in data:
+        os.unlink(data.pop('path'))
     return json.dumps(data)
 
-def process_send(_data, _command, return_code, out, err):
+def transfer_progress(data, text):
+    data = json.loads(data)
+    buffer = find_buffer(data['server'], data['channel'])
+    if buffer != None:
+        buffer.edit(data, text)
+
+def process_send(data, _command, return_code, out, err):
     if return_code == w.WEECHAT_HOOK_PROCESS_ERROR or out == '':
-        w.prnt("", "Failed to download file.")
+        transfer_progress(data, "Failed to download file.")
     else:
         data = json.loads(out)
         buffer = find_buffer(data['server'], data['channel'])
-        if buffer != None:
-            if data.get('payload', None) == None:
-                buffer.edit(make_instance(Failure, **data))
+        if 'path' not in data:
+            if buffer != None:
+                buffer.edit(data, data['text'])
+        elif buffer == None:
+            os.unlink(data['path'])
+        else:
+            update = buffer.make_instance(Data, channel=data['channel'], id=data['id'], filename=data['filename'], **{'content-type': data['content-type']})
+            buffer.server.queue_upload(Upload(buffer, update, data['path'], spooled=True))
     return w.WEECHAT_RC_OK
 
-def write_file(data):
+def store_file(data, progress=None, payload=None):
+    """Decode a Data payload into the data store, unless it holds it already.
+
+Blobs are named by the SHA-256 hash of their content, see DataStore. A
+new blob is written to the store's tmp/ directory first and then renamed
+into place, so that it never shows up half written."""
+    import tempfile
     data = json.loads(data)
     try:
-        with open(data['url'], 'wb') as file:
-            file.write(base64.b64decode(data['payload']))
-        data['payload'] = ''
-        data['text'] = f"Sent file file://{data['url']}"
+        content = base64.b64decode(payload)
+        digest = hashlib.sha256(content).hexdigest()
+        bucket = f"{data['directory']}/blobs/{digest[:2]}"
+        os.makedirs(bucket, exist_ok=True)
+        existing = [name for name in os.listdir(bucket) if name.startswith(digest)]
+        if existing:
+            name = existing[0]
+        else:
+            name = digest+data['suffix']
+            os.makedirs(data['directory']+'/tmp', exist_ok=True)
+            (fd, path) = tempfile.mkstemp(prefix='lichat-', dir=data['directory']+'/tmp')
+            with os.fdopen(fd, 'wb') as file:
+                file.write(content)
+            os.replace(path, f"{bucket}/{name}")
+        data['sha256'] = digest
+        data['size'] = len(content)
+        data['file'] = f"blobs/{digest[:2]}/{name}"
+        data['text'] = f"Sent file file://{bucket}/{name}"
     except Exception as e:
         data['text'] = f"Internal error: {e}"
     return json.dumps(data)
 
-def upload_file(data):
+def upload_file(data, progress=None, payload=None):
     data = json.loads(data)
     try:
         # FIXME: try to remove dependency on requests, because
         # requests -> simplejson -> decimal, which provokes the
         # MPD_SETMINALLOC issue.
         import requests
-        headers = {'Authorization': f'Client-ID {imgur_client_id}'}
+        headers = {'Authorization': f"Client-ID {data.pop('client_id')}"}
         post = {'type': 'file', 'title': data['filename']}
         files = {}
+        content = base64.b64decode(payload)
         if data['content-type'].startswith('image'):
-            files['image'] = (data['filename'], base64.b64decode(data['payload']), data['content-type'])
+            files['image'] = (data['filename'], content, data['content-type'])
         else:
-            files['video'] = (data['filename'], base64.b64decode(data['payload']), data['content-type'])
+            files['video'] = (data['filename'], content, data['content-type'])
         r = requests.post(url='https://api.imgur.com/3/image.json', data=post, files=files, headers=headers)
         response = json.loads(r.text)
         if response['success']:
-            data['payload'] = response['data']['link']
             data['text'] = f"Sent file {response['data']['link']}"
         else:
-            data['payload'] = ''
             data['text'] = f"Imgur failed: {response['data']['error']}"
     except Exception as e:
         data['text'] = f"Internal error: {e}"
     return json.dumps(data)
 
-def process_upload(_data, _command, return_code, out, err):
+def process_upload(data, _command, return_code, out, err):
     if return_code == w.WEECHAT_HOOK_PROCESS_ERROR or out == '':
         w.prnt("", "Failed to upload file.")
     else:
         try:
             data = json.loads(out)
-            update = make_instance(Message, **data)
             buffer = find_buffer(data['server'], data['channel'])
             if buffer != None:
-                buffer.edit(update)
+                buffer.edit(data, data['text'])
         except Exception as e:
             w.prnt("", f"Failed to upload file: couldn't parse:\n{out}")
     return w.WEECHAT_RC_OK
 
+def process_store(data, command, return_code, out, err):
+    if return_code != w.WEECHAT_HOOK_PROCESS_ERROR and out != '':
+        stored = json.loads(out)
+        store = get_data_store()
+        if 'sha256' in stored and store.directory == stored['directory']:
+            if stored['sha256'] in store.blobs or os.path.exists(store.directory+'/'+stored['file']):
+                store.add(stored['key'], stored['sha256'], stored['size'], stored['filename'], stored['content-type'], stored['file'])
+            else:
+                # Found by the worker, but evicted since.
+                stored['text'] = "Failed to save file: it was evicted from the store meanwhile."
+                out = json.dumps(stored)
+    return process_upload(data, command, return_code, out, err)
+
+# Functions transfer workers may run, by name
+transfer_functions = {
+    'download_file': download_file,
+    'store_file': store_file,
+    'upload_file': upload_file
+}
+
+class TransferWorker:
+    """A long-lived child process running transfer jobs, see TransferPool.
+
+Jobs are written to it as JSON lines on one pipe, each followed by the
+job's base64 payload if it has one, and it answers on another, whose
+read end is hooked with hook_fd. The job pipe is written without
+blocking, the rest following whenever it becomes writable again."""
+    # How much of a payload to encode for the job pipe at a time
+    payload_chunk_size = 65536
+
+    def __init__(self, index):
+        self.index = index
+        (self.jobs_read, self.jobs_write) = os.pipe()
+        (self.results_read, self.results_write) = os.pipe()
+        os.set_blocking(self.results_read, False)
+        os.set_blocking(self.jobs_write, False)
+        self.job = None
+        self.received = ''
+        self.outgoing = bytearray()
+        self.payload = ''
+        self.payload_sent = 0
+        self.fd_hook = None
+        self.write_hook = None
+        self.process = None
+
+    def start(self):
+        # The child's ends of the pipes stay open here until stop, as WeeChat
+        # may only fork the process later. Its exit is noticed through the
+        # process hook instead.
+        self.process = w.hook_process('func:transfer_worker', 0, 'transfer_worker_exit_cb', str(self.index))
+        self.fd_hook = w.hook_fd(self.results_read, 1, 0, 0, 'transfer_results_cb', str(self.index))
+
+    def run(self, job):
+        self.job = job
+        # Only kept here, and let go of once written.
+        self.payload = job.pop('payload') or ''
+        self.payload_sent = 0
+        header = {'func': job['func'], 'data': job['data'], 'payload': len(self.payload)}
+        self.outgoing += (json.dumps(header) + '\n').encode('utf-8')
+        self.write_job()
+
+    def write_job(self):
+        """Write as much of the current job as the pipe takes without blocking."""
+        try:
+            while self.outgoing:
+                sent = os.write(self.jobs_write, self.outgoing)
+                del self.outgoing[:sent]
+                if not self.outgoing and self.payload_sent < len(self.payload):
+                    end = self.payload_sent + self.payload_chunk_size
+                    self.outgoing += self.payload[self.payload_sent:end].encode('ascii')
+                    self.payload_sent = end
+        except BlockingIOError:
+            pass
+        except OSError:
+            # The worker is gone, which transfer_worker_exit_cb takes care of.
+            logger.debug(f"Failed to write to transfer worker {self.index}", exc_info=True)
+            self.outgoing.clear()
+        if self.outgoing:
+            if self.write_hook == None:
+                self.write_hook = w.hook_fd(self.jobs_write, 0, 1, 0, 'transfer_jobs_cb', str(self.index))
+        else:
+            self.payload = ''
+            if self.write_hook != None:
+                w.unhook(self.write_hook)
+                self.write_hook = None
+
+    def stop(self):
+        if self.fd_hook != None:
+            w.unhook(self.fd_hook)
+            self.fd_hook = None
+        if self.write_hook != None:
+            w.unhook(self.write_hook)
+            self.write_hook = None
+        if self.process != None:
+            w.unhook(self.process)
+            self.process = None
+        for fd in (self.jobs_read, self.jobs_write, self.results_read, self.results_write):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+class TransferPool:
+    """Runs file transfers in a few persistent worker processes.
+
+Workers are forked on demand up to behaviour.transfer_workers and then
+kept, instead of forking WeeChat for every transfer. Jobs wait in a
+queue for an idle worker. Only one job larger than large_transfer_size
+runs at a time, so that small files are not stuck behind large ones."""
+    large_transfer_size = 8 * 1024 * 1024
+
+    def __init__(self):
+        self.workers = {}
+        self.queue = deque()
+        self.next_index = 0
+
+    def submit(self, func, callback, data, size=0, progress=None, payload=None):
+        """Run func(data) in a worker and pass its result to the named process callback.
+
+Progress texts the function reports are passed to the function named by
+progress, along with data. A base64 payload is passed to func as is,
+through the job pipe rather than the JSON data."""
+        self.queue.append({'func': func, 'callback': callback, 'data': data, 'size': size, 'progress': progress, 'payload': payload})
+        self.dispatch()
+
+    def dispatch(self):
+        busy_large = any(worker.job['size'] > self.large_transfer_size for worker in self.workers.values() if worker.job)
+        for job in list(self.queue):
+            if job['size'] > self.large_transfer_size and busy_large:
+                continue
+            worker = self.idle_worker()
+            if worker == None:
+                return
+            self.queue.remove(job)
+            busy_large = busy_large or job['size'] > self.large_transfer_size
+            worker.run(job)
+
+    def idle_worker(self):
+        for worker in self.workers.values():
+            if worker.job == None:
+                return worker
+        if len(self.workers) < behaviour.transfer_workers:
+            worker = TransferWorker(self.next_index)
+            self.next_index += 1
+            self.workers[worker.index] = worker
+            worker.start()
+            return worker
+        return None
+
+    def progress(self, worker, text):
+        job = worker.job
+        if job != None and job['progress'] != None:
+            globals()[job['progress']](job['data'], text)
+
+    def finish(self, worker, return_code, out):
+        job = worker.job
+        worker.job = None
+        if job != None:
+            globals()[job['callback']](job['data'], f"func:{job['func']}", return_code, out, '')
+        self.dispatch()
+
+    def remove(self, worker):
+        worker.stop()
+        self.workers.pop(worker.index, None)
+        self.finish(worker, w.WEECHAT_HOOK_PROCESS_ERROR, '')
+
+    def stop(self):
+        for worker in list(self.workers.values()):
+            worker.stop()
+        self.workers.clear()
+        self.queue.clear()
+
+transfer_pool = TransferPool()
+
+def transfer_worker(index):
+    """Main loop of a transfer worker process, see TransferWorker."""
+    worker = transfer_pool.workers[int(index)]
+    # Close everything inherited from WeeChat but our own pipe ends. Server
+    # sockets would otherwise stay open for as long as the worker lives,
+    # and other workers would never see their job pipe close.
+    (low, high) = sorted((worker.jobs_read, worker.results_write))
+    os.closerange(3, low)
+    os.closerange(low+1, high)
+    os.closerange(high+1, os.sysconf('SC_OPEN_MAX'))
+    with os.fdopen(worker.jobs_read, 'rb') as jobs, os.fdopen(worker.results_write, 'w') as results:
+        for line in jobs:
+            job = json.loads(line)
+            def report(text):
+                results.write(json.dumps({'progress': text}) + '\n')
+                results.flush()
+            args = {}
+            if job['payload']:
+                args['payload'] = jobs.read(job['payload']).decode('ascii')
+            out = transfer_functions[job['func']](job['data'], report, **args)
+            results.write(json.dumps(out) + '\n')
+            results.flush()
+    return ''
+
+def transfer_results_cb(index, fd):
+    worker = transfer_pool.workers.get(int(index), None)
+    if worker == None:
+        return w.WEECHAT_RC_OK
+    try:
+        chunk = os.read(fd, 65536)
+    except BlockingIOError:
+        return w.WEECHAT_RC_OK
+    worker.received += chunk.decode('utf-8')
+    while '\n' in worker.received:
+        (line, worker.received) = worker.received.split('\n', 1)
+        message = json.loads(line)
+        if isinstance(message, dict):
+            transfer_pool.progress(worker, message['progress'])
+        else:
+            transfer_pool.finish(worker, 0, message)
+    return w.WEECHAT_RC_OK
+
+def transfer_jobs_cb(index, fd):
+    worker = transfer_pool.workers.get(int(index), None)
+    if worker != None:
+        worker.write_job()
+    return w.WEECHAT_RC_OK
+
+def transfer_worker_exit_cb(index, _command, return_code, out, err):
+    if return_code == w.WEECHAT_HOOK_PROCESS_RUNNING:
+        return w.WEECHAT_RC_OK
+    if err != '':
+        logger.warning(f"Transfer worker {index} failed: {err}")
+    worker = transfer_pool.workers.get(int(index), None)
+    if worker != None:
+        worker.process = None
+        transfer_pool.remove(worker)
+    return w.WEECHAT_RC_OK
+
+def read_emote_manifest(filename, emotes):
+    """Read the name -> file/hash manifest of an emote directory.
+
+Entries whose emote is no longer on disk are dropped."""
+    try:
+        with open(filename, 'r') as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        return {}
+    return {name: entry for name, entry in manifest.items() if name in emotes}
+
+def write_emotes(data):
+    data = json.loads(data)
+    try:
+        server = servers[data['server']]
+        for name in data['names']:
+            server.client.emotes[name].offload(server.emote_dir)
+        with open(server.emote_manifest_file+'.tmp', 'w') as file:
+            json.dump(server.emote_manifest, file)
+        os.replace(server.emote_manifest_file+'.tmp', server.emote_manifest_file)
+        return f"Wrote {len(data['names'])} emotes"
+    except Exception as e:
+        return f"Internal error: {e}"
+
+def emote_write_cb(name, _remaining):
+    server = servers.get(name, None)
+    if server != None:
+        server.start_emote_writer()
+    return w.WEECHAT_RC_OK
+
+def process_emotes(data, _command, return_code, out, err):
+    name = json.loads(data)['server']
+    if return_code == w.WEECHAT_HOOK_PROCESS_ERROR or out == '':
+        logger.warning(f"[{name}] Failed to write emotes.")
+    else:
+        logger.debug(f"[{name}] {out}")
+    server = servers.get(name, None)
+    if server != None:
+        server.emote_writer = None
+        if server.emote_writes:
+            server.start_emote_writer()
+    return w.WEECHAT_RC_OK
+
 ### Completion
 def command_completion_cb(_data, item, w_buffer, completion):
     for k in commands.keys():
@@ -1444,14 +2887,15 @@ def emote_completion_cb(_data, item, w_buffer, completion):
     buffer = weechat_buffer_to_representation(w_buffer)
     if buffer == None: return w.WEECHAT_RC_OK
     
-    for emote in buffer.server.client.emotes:
-        w.hook_completion_list_add(completion, emote, 0, w.WEECHAT_LIST_POS_SORT)
+    for emote in buffer.server.emote_index:
+        w.hook_completion_list_add(completion, emote, 0, w.WEECHAT_LIST_POS_END)
     return w.WEECHAT_RC_OK
 
 def last_emote(text, emotes):
-    match = re.match(r'.*:([^:]+):$', text)
-    if match != None and match.group(1).lower() in emotes:
-        return match.group(1)
+    if text.endswith(':'):
+        parts = text[:-1].rsplit(':', 1)
+        if len(parts) == 2 and parts[1] != '' and parts[1] in emotes:
+            return parts[1]
 
 def input_complete_cb(_data, w_buffer, command):
     buffer = weechat_buffer_to_representation(w_buffer)
@@ -1461,7 +2905,7 @@ def input_complete_cb(_data, w_buffer, command):
     text = w.buffer_get_string(w_buffer, 'input')
     index = int(w.buffer_get_string(w_buffer, 'localvar_lichat_complete_index'))
     prefix = w.buffer_get_string(w_buffer, 'localvar_lichat_complete_prefix')
-    emotes = buffer.server.client.emotes.keys()
+    emotes = buffer.server.emote_index
     try:
         ## If we aren't ending with a full emote, or the emote is
         ## from a different prefix than we're used to, reset.
@@ -1472,16 +2916,11 @@ def input_complete_cb(_data, w_buffer, command):
 
         ## Now find all emotes that would match.
         last_colon = prefix.rindex(':')+1
-        find = prefix[last_colon:].lower()
-        matches = []
-        for emote in emotes:
-            if emote.startswith(find):
-                matches.append(emote)
+        matches = emotes.prefixed(prefix[last_colon:])
 
         ## If there are any matches, select the next one, and update our cache.
         if 0 < len(matches):
-            matches.sort()
-            match = matches[index]
+            match = emotes[matches[index]]
             if command == 'input complete_next':
                 index = (index+1) % len(matches)
             else:
@@ -1507,6 +2946,56 @@ def cfg(section, option, type=str, default=None, evaluate=False):
     elif type == bool: return w.config_boolean(cfg)
     elif type == int: return w.config_integer(cfg)
 
+class Settings:
+    """Snapshot of a config section's options as plain attributes.
+
+Rebuilt by config_updated, so hot paths can avoid going through cfg()."""
+    def __init__(self, section, options, prefix=''):
+        for (name, type, default) in options:
+            setattr(self, name, cfg(section, prefix+name, type, default))
+
+behaviour_settings = [
+    ('data_save_directory', str, ''),
+    ('data_save_types', str, 'all'),
+    ('data_save_incoming', bool, False),
+    ('data_save_max_size', int, 1024),
+    ('imgur_client_id', str, ''),
+    ('highlight', str, ''),
+    ('backfill_timeout', int, 1000),
+    ('backfill_window_count', int, 255),
+    ('backfill_window_time', int, 30),
+    ('recent_messages_count', int, 1000),
+    ('receive_time_budget', int, 50),
+    ('receive_update_budget', int, 500),
+    ('connect_timeout', int, 30),
+    ('transfer_workers', int, 2),
+    ('download_max_size', int, 100),
+    ('download_timeout', int, 30),
+    ('ping_interval', int, 30),
+    ('lag_reconnect', int, 60),
+    ('lag_min_show', int, 500),
+    ('loglevel', str, 'WARNING'),
+    ('logtraceback', bool, False),
+    ('logfile', bool, False),
+    ('profile_startup', bool, False)
+]
+
+server_settings = [
+    ('name', str, ''),
+    ('host', str, ''),
+    ('port', int, 1111),
+    ('username', str, ''),
+    ('ssl', bool, False),
+    ('autojoin', str, ''),
+    ('autoconnect', bool, False),
+    ('autoreconnect', bool, False),
+    ('autoreconnect_delay', int, 60),
+    ('autoreconnect_max_delay', int, 900),
+    ('send_rate', int, 10),
+    ('send_burst', int, 20),
+    ('highlight', str, 'username')
+]
+
 def wcfgstr(option, coloropt=None):
     """Get a text string from weechat's (global) config.
 
@@ -1523,6 +3012,33 @@ The optional 2nd argument specifies a text string which is colored with the colo
         return f"{wcfgcolor(option)}{text}{w.color('reset')}"
     return w.color(w.config_color(w.config_get(option)))
 
+render_styles = {
+    'color': lambda name: w.color(name),
+    'prefix': lambda name: w.prefix(name),
+    'boolean': lambda option: w.config_boolean(w.config_get(option)),
+    'option_color': lambda option: wcfgcolor(option),
+    'nick_color': lambda nick: w.color(w.info_get("nick_color_name", nick)),
+    'nick_prefix': lambda: wcfgstr('weechat.look.nick_prefix', 'weechat.color.chat_nick_prefix'),
+    'nick_suffix': lambda: wcfgstr('weechat.look.nick_suffix', 'weechat.color.chat_nick_suffix')
+}
+
+def render_style(style, *args):
+    """Get a color, prefix or option used when rendering lines.
+
+Results are memoized until one of weechat's color or nick options changes,
+see render_style_changed_cb."""
+    key = (style, *args)
+    value = render_cache.get(key, None)
+    if value is None:
+        if 4096 <= len(render_cache):
+            render_cache.clear()
+        value = render_cache[key] = render_styles[style](*args)
+    return value
+
+def render_style_changed_cb(_data, option, value):
+    render_cache.clear()
+    return w.WEECHAT_RC_OK
+
 def server_options(server):
     found = {}
     cfg = config['server']
@@ -1553,13 +3069,14 @@ def config_delete_option_cb(section_name, file, section, option):
 
 def config_updated(full=False):
     logger.debug(f"config_updated(full={full})")
-    global imgur_client_id, data_save_directory, data_save_types, logtraceback, logfilehandler
-    data_save_directory = cfg('behaviour', 'data_save_directory')
-    data_save_types = cfg('behaviour', 'data_save_types').split(',')
-    imgur_client_id = cfg('behaviour', 'imgur_client_id')
-    logweehandler.setLevel(cfg('behaviour', 'loglevel', str, 'WARNING'))
-    logtraceback = cfg('behaviour', 'logtraceback', bool, False)
-    if cfg('behaviour', 'logfile', bool, False):
+    global behaviour, imgur_client_id, data_save_directory, data_save_types, logtraceback, logfilehandler
+    behaviour = Settings('behaviour', behaviour_settings)
+    data_save_directory = behaviour.data_save_directory
+    data_save_types = behaviour.data_save_types.split(',')
+    imgur_client_id = behaviour.imgur_client_id
+    logweehandler.setLevel(behaviour.loglevel)
+    logtraceback = behaviour.logtraceback
+    if behaviour.logfile:
         if logfilehandler is None:
             logfilehandler = logging.handlers.RotatingFileHandler(w.string_eval_path_home("%h/lichat.log", '', '', ''),
                                                                   maxBytes=4000000, backupCount=8,
@@ -1573,9 +3090,13 @@ def config_updated(full=False):
             logfilehandler = None
     
     for server in list(servers.keys()):
-        if not servers[server].is_connected():
+        if not servers[server].is_connected() and servers[server].reconnect_at is None:
             del servers[server]
 
+    for server in servers.values():
+        server.update_settings()
+    startup_phase('config_updated')
+
     for serverkey, sconf in servers_options().items():
         server = w.config_string(sconf['name']) or serverkey
         if server not in servers:
@@ -1586,9 +3107,13 @@ def config_updated(full=False):
                    host=w.config_string(sconf['host']),
                    port=w.config_integer(sconf['port']),
                    ssl=w.config_boolean(sconf['ssl']))
+    startup_phase('servers')
 
 def config_option_change_cb(option_name, option):
     logger.debug(f"config_option_change_cb({option_name}) -> {w.config_string(option) or w.config_integer(option)}")
+    if config_reloading:
+        # The setup runs config_updated once the whole file is read.
+        return w.WEECHAT_RC_OK
     config_updated(full=False)
     if option_name.startswith('server.'):
         serverkey = option_name.split('.', maxsplit=2)[1]
@@ -1656,6 +3181,9 @@ def config_server_read_cb(data, file, section, name, value):
                 {'name': f'{parts[0]}.autoconnect', 'default': False},
                 {'name': f'{parts[0]}.autoreconnect', 'default': True},
                 {'name': f'{parts[0]}.autoreconnect_delay', 'min': 1, 'default': 60},
+                {'name': f'{parts[0]}.autoreconnect_max_delay', 'min': 1, 'default': 900},
+                {'name': f'{parts[0]}.send_rate', 'min': 1, 'max': 1000, 'default': 10},
+                {'name': f'{parts[0]}.send_burst', 'min': 1, 'max': 1000, 'default': 20},
                 {'name': f'{parts[0]}.highlight', 'default': 'username'}
             ])
             option = w.config_search_option(file, section, name)
@@ -1671,13 +3199,16 @@ def shutdown_cb():
                 server.disconnect()
             except:
                 logger.exception(f"[server.name] Error while disconnecting")
-
+    transfer_pool.stop()
+    if data_store != None and data_store.save_timer != None:
+        data_store.save()
     return w.WEECHAT_RC_OK
 
 ### Setup
 if __name__ == '__main__' and import_ok:
     if w.register(SCRIPT_NAME, SCRIPT_AUTHOR, SCRIPT_VERSION,
                         SCRIPT_LICENSE, SCRIPT_DESC, 'shutdown_cb', ''):
+        startup_phase('imports')
         logweehandler = WeechatHandler(level=logging.WARNING)
         logging.basicConfig(handlers=[logweehandler], level=logging.DEBUG)
         
@@ -1686,7 +3217,11 @@ if __name__ == '__main__' and import_ok:
             {'name': 'data_save_directory', 'default': w.info_get('weechat_dir', '')+'/lichat/downloads/',
              'description': f"Where to save uploaded files to."},
             {'name': 'data_save_types', 'default': 'all',
-             'description': f"Which file types to save locally. Should be a comma-separated list of mime-types. Setting to 'all' will save files of any type."},
+             'description': f"Which file types to save locally. Should be a comma-separated list of mime-types, which may contain wildcards such as image/*. Setting to 'all' will save files of any type."},
+            {'name': 'data_save_incoming', 'default': False,
+             'description': f"Whether to also save files sent by other users, not just your own."},
+            {'name': 'data_save_max_size', 'default': 1024, 'min': 0, 'max': 1048576,
+             'description': f"How much space saved files may take up (MiB). Beyond that the least recently sent files are deleted. 0 means no limit."},
             {'name': 'imgur_client_id', 'default': '',
              'description': f"An imgur.com client ID token. If set, will upload compatible data files to imgur and replace with a link instead of saving the file locally."},
             {'name': 'highlight', 'default': '',
@@ -1697,12 +3232,33 @@ if __name__ == '__main__' and import_ok:
              'description': "For tracking whether an update has already been seen, how many recent updates should be stored (per channel)?"},
             {'name': 'backfill_window_time', 'default': 30, 'min': 2, 'max': 65535,
              'description': "For tracking whether an update has already been seen, how long should updates be stored (seconds)?"},
+            {'name': 'recent_messages_count', 'default': 1000, 'min': 1, 'max': 65535,
+             'description': "How many recent messages per channel can be addressed by number in /lichat edit and /lichat react."},
+            {'name': 'receive_time_budget', 'default': 50, 'min': 1, 'max': 10000,
+             'description': "How long to spend handling received updates before letting WeeChat process input (milliseconds). Remaining updates are handled shortly after."},
+            {'name': 'receive_update_budget', 'default': 500, 'min': 1, 'max': 65535,
+             'description': "How many received updates to handle at most before letting WeeChat process input. Remaining updates are handled shortly after."},
+            {'name': 'connect_timeout', 'default': 30, 'min': 1, 'max': 3600,
+             'description': "How long connecting to a server may take in total, including DNS, TLS and the lichat handshake (seconds)."},
+            {'name': 'transfer_workers', 'default': 2, 'min': 1, 'max': 16,
+             'description': "How many worker processes may run file downloads, saves and uploads at the same time, which also limits how many URLs one /lichat send downloads in parallel. Workers are started as needed and kept running."},
+            {'name': 'download_max_size', 'default': 100, 'min': 1, 'max': 65535,
+             'description': "Largest file /lichat send will download from a URL (MiB)."},
+            {'name': 'download_timeout', 'default': 30, 'min': 1, 'max': 3600,
+             'description': "How long /lichat send waits for a URL to connect, and for each read from it (seconds)."},
+            {'name': 'ping_interval', 'default': 30, 'min': 1, 'max': 3600,
+             'description': "How often to ping servers to measure the lag (seconds)."},
+            {'name': 'lag_reconnect', 'default': 60, 'min': 1, 'max': 3600,
+             'description': "Reconnect to a server if a ping has not been answered for this long (seconds)."},
+            {'name': 'lag_min_show', 'default': 500, 'min': 0, 'max': 3600000,
+             'description': "Minimum lag to show in the lichat_lag bar item (milliseconds)."},
             # can also be CRITICAL but that would hide too much...
             {'name': 'loglevel', 'default': 'WARNING', 'enum': 'ERROR|WARNING|INFO|DEBUG',
              'optype': 'integer',
              'description': f"weelichat log level"},
             {'name': 'logtraceback', 'default': False, 'description': "Include exception traceback in error messages"},
-            {'name': 'logfile', 'default': False, 'description': 'also log all messages (DEBUG) to file (%h/lichat.log)'}
+            {'name': 'logfile', 'default': False, 'description': 'also log all messages (DEBUG) to file (%h/lichat.log)'},
+            {'name': 'profile_startup', 'default': False, 'description': 'Report how long loading the script took, per phase. The last report is also shown by /lichat startup.'}
         ])
         config_section(config_file, 'server_default', [
             {'name': 'name', 'default': '',
@@ -1724,7 +3280,13 @@ if __name__ == '__main__' and import_ok:
             {'name': 'autoreconnect', 'default': True,
              'description': f"Whether to automatically reconnect when the client disconnects for some reason."},
             {'name': 'autoreconnect_delay', 'min': 1, 'default': 60,
-             'description': f"How long to wait between reconnection attempts, in seconds."},
+             'description': f"How long to wait before the first reconnection attempt, in seconds. The wait doubles with every failed attempt."},
+            {'name': 'autoreconnect_max_delay', 'min': 1, 'default': 900,
+             'description': f"The longest to wait between reconnection attempts, in seconds."},
+            {'name': 'send_rate', 'min': 1, 'max': 1000, 'default': 10,
+             'description': f"How many updates per second to send at most, so as not to get throttled by the server. Updates beyond that are queued, messages ahead of bulk requests such as joins and backfills."},
+            {'name': 'send_burst', 'min': 1, 'max': 1000, 'default': 20,
+             'description': f"How many updates may be sent at once before send_rate applies."},
             {'name': 'highlight', 'default': 'username',
              'description': f"A comma-separated list of words to highlight in any buffer for this server. The special word 'username' will be replaced with the username used for this server."}
         ])
@@ -1739,9 +3301,15 @@ if __name__ == '__main__' and import_ok:
             {'name': 'tynet.autoconnect', 'default': False},
             {'name': 'tynet.autoreconnect', 'default': True},
             {'name': 'tynet.autoreconnect_delay', 'min': 1, 'default': 60},
+            {'name': 'tynet.autoreconnect_max_delay', 'min': 1, 'default': 900},
+            {'name': 'tynet.send_rate', 'min': 1, 'max': 1000, 'default': 10},
+            {'name': 'tynet.send_burst', 'min': 1, 'max': 1000, 'default': 20},
             {'name': 'tynet.highlight', 'default': 'username'}
         ], read_cb='config_server_read_cb')
+        config_reloading = True
         w.config_reload(config_file)
+        config_reloading = False
+        startup_phase('config sections')
         config_updated(full=True)
         
         w.hook_command('lichat', 'Prefix for lichat related commands',
@@ -1767,6 +3335,10 @@ if __name__ == '__main__' and import_ok:
         w.hook_command_run('/whois', 'user_info_command_cb', '')
 
         w.bar_item_new('input_prompt', '(extra)input_prompt_cb', '')
+        w.bar_item_new('lichat_outbox', '(extra)outbox_item_cb', '')
+        w.bar_item_new('lichat_lag', '(extra)lag_item_cb', '')
+        w.hook_signal('buffer_switch', 'bar_items_update_cb', '')
+        w.hook_timer(tick_interval, 0, 0, 'tick_cb', '')
 
         w.hook_completion('lichat_command', 'complete Lichat commands', 'command_completion_cb', '')
         w.hook_completion('lichat_channel', 'complete Lichat channel names', 'channel_completion_cb', '')
@@ -1775,7 +3347,11 @@ if __name__ == '__main__' and import_ok:
         w.hook_completion('lichat_channel_key', 'complete Lichat channel info keys', 'channel_key_completion_cb', '')
         w.hook_completion('lichat_emote', 'complete :emotes: for Lichat', 'emote_completion_cb', '')
         w.hook_command_run('/input complete_*', 'input_complete_cb', '')
+        w.hook_signal('buffer_cleared', 'buffer_cleared_cb', '')
+        for option in ['weechat.color.*', 'weechat.look.nick_*', 'weechat.look.prefix_*', 'irc.look.*']:
+            w.hook_config(option, 'render_style_changed_cb', '')
         
+        startup_phase('hooks')
         logger.info("Loaded script")
 
         for server, sconf in servers_options().items():
@@ -1783,7 +3359,6 @@ if __name__ == '__main__' and import_ok:
             instance = servers[server]
             if w.config_boolean(sconf['autoconnect']) and not instance.is_connected():
                 try_connect('', instance)
+        finish_startup()
 
-## TODO: buffer sending to avoid getting throttled by the server.
-## TODO: lag estimation
 ## TODO: config seems to get overridden / not properly saved sometimes?